@@ -0,0 +1,54 @@
+# bench/bench_memory.py - 使用者資料記憶體比較：舊的 dict 版面 vs UserStore（__slots__ + int key）
+# 用法：python bench/bench_memory.py [人數，預設 100000]
+# 在暫存目錄匯入 main，不會動到 ./data。
+
+import os
+import sys
+import random
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix="bench-"))
+os.environ.setdefault("ECONOMY_JOURNAL", "0")
+
+import main  # noqa: E402
+
+
+def fake_users(n: int) -> dict:
+    rnd = random.Random(42)
+    base = 1_100_000_000_000_000_000
+    data = {}
+    for i in range(n):
+        d = {"money": rnd.randint(0, 5000), "xp": rnd.randint(0, 99), "level": rnd.randint(1, 20), "tickets": 0, "items": {}}
+        if rnd.random() < 0.05:  # 少數人有道具
+            d["items"] = {"VIP卡": 1}
+        data[str(base + i * 7919)] = d
+    return data
+
+
+def measure(build):
+    tracemalloc.start()
+    obj = build()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return obj, size, peak
+
+
+def main_():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    src = fake_users(n)
+    text = main.json.dumps(src)
+    legacy, legacy_bytes, legacy_peak = measure(lambda: main.json.loads(text))
+    del legacy
+    compact, compact_bytes, compact_peak = measure(lambda: main.UserStore(main.json.loads(text)))
+    print(f"使用者數：{n}")
+    print(f"dict 版面：  常駐 {legacy_bytes / 1e6:7.1f} MB（{legacy_bytes / n:5.0f} B/人）  載入峰值 {legacy_peak / 1e6:7.1f} MB")
+    print(f"UserStore：  常駐 {compact_bytes / 1e6:7.1f} MB（{compact_bytes / n:5.0f} B/人）  載入峰值 {compact_peak / 1e6:7.1f} MB")
+    retained = sum(sys.getsizeof(r) for r in compact._d.values())
+    print(f"UserStore 常駐：紀錄本體約 {retained / n:.0f} B/人")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,273 @@
+# bench/loadtest.py - 離線壓力測試：用假的 Interaction / Member / Message 直接驅動真正的 handler
+# 不需要連 Discord。報告每個情境的吞吐量、p50/p99 延遲、每事件寫入位元組與 RSS。
+#
+# 用法：
+#   python bench/loadtest.py                       # 預設 5000 人、每情境 5000 次、不限速
+#   python bench/loadtest.py --users 50000 --events 20000 --rate 2000
+#   python bench/loadtest.py --backend sqlite --journal 0 --scenarios on_message,work
+#   python bench/loadtest.py --backend sqlite --user-cache 1000    # LRU 使用者快取
+#
+# 在暫存目錄執行，不會動到 ./data。
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import resource
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ["on_message", "work", "pay", "leaderboard", "scratch", "lottery"]
+
+
+# ----- 假物件 -----
+class FakeChannel:
+    def __init__(self, cid: int):
+        self.id = cid
+
+    async def send(self, content=None, **kwargs):
+        return None
+
+
+class FakeMember:
+    def __init__(self, uid: int):
+        self.id = uid
+        self.bot = False
+        self.display_name = f"user{uid}"
+        self.mention = f"<@{uid}>"
+        self.roles = []
+
+    async def send(self, content=None, **kwargs):
+        return None
+
+
+class FakeGuild:
+    def __init__(self, gid: int, members: dict):
+        self.id = gid
+        self.name = "bench"
+        self.members = members
+
+    def get_member(self, uid: int):
+        return self.members.get(uid)
+
+
+class FakeResponse:
+    def __init__(self):
+        self.done = False
+
+    async def send_message(self, content=None, **kwargs):
+        self.done = True
+
+    async def edit_message(self, **kwargs):
+        self.done = True
+
+    async def defer(self, **kwargs):
+        self.done = True
+
+    def is_done(self):
+        return self.done
+
+
+class FakeFollowup:
+    async def send(self, content=None, **kwargs):
+        return None
+
+
+class FakeInteraction:
+    def __init__(self, user: FakeMember, guild: FakeGuild):
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+        self.created_at = datetime.now(timezone.utc)
+
+
+class FakeMessage:
+    def __init__(self, state, author: FakeMember, channel: FakeChannel, guild: FakeGuild, content: str):
+        self._state = state  # commands.Context 會讀
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.content = content
+        self.id = random.getrandbits(62)
+
+
+# ----- 量測 -----
+def written_bytes() -> int:
+    """本行程呼叫 write() 的總位元組（Linux /proc/self/io 的 wchar）。"""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def percentile(sorted_vals: list, p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals) * p))]
+
+
+async def run_scenario(main, name: str, make_event, events: int, rate: float):
+    """以固定速率（rate<=0 表示不限速）觸發 events 次，回傳統計。"""
+    latencies = []
+
+    async def one(i):
+        start = time.perf_counter()
+        await make_event(i)
+        latencies.append(time.perf_counter() - start)
+
+    await main.PERSIST.flush_async()
+    before = written_bytes()
+    t0 = time.perf_counter()
+    tasks = []
+    for i in range(events):
+        if rate > 0:
+            delay = t0 + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(one(i)))
+        if rate <= 0 and i % 200 == 199:
+            await asyncio.sleep(0)  # 讓背景 task（flush、XP 批次）有機會跑
+    await asyncio.gather(*tasks)
+    await main.JOBS.drain()  # defer 後排進工作佇列的部分也算進去
+    elapsed = time.perf_counter() - t0
+    main.drain_message_xp()
+    await main.PERSIST.flush_async()
+    if main.ECONOMY_JOURNAL:
+        await main.JOURNAL.compact()
+    wrote = written_bytes() - before
+    latencies.sort()
+    return {
+        "scenario": name,
+        "events": events,
+        "throughput": events / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "bytes_per_event": wrote / events,
+        "rss_mb": rss_mb(),
+    }
+
+
+async def bench(args):
+    import main
+
+    main.load_state()
+    # 關掉指令冷卻，量的是 handler 本身而不是拒絕路徑（訊息 XP 冷卻照 XP_COOLDOWN）
+    for name in ("work", "scratch", "lottery"):
+        main.COOLDOWN_WINDOWS[name] = 0
+    # process_commands 需要 bot.user；離線時給一個假的
+    main.bot._connection.user = FakeMember(1)
+    members = {uid: FakeMember(uid) for uid in range(10_000, 10_000 + args.users)}
+    guild = FakeGuild(main.GUILD_ID, members)
+    channels = [FakeChannel(900 + i) for i in range(10)]
+    uids = list(members)
+    rnd = random.Random(1)
+
+    # 每人先給點錢，讓 pay / scratch / lottery 有餘額可扣
+    for uid in uids:
+        main.econ_apply(str(uid), "seed", money=10_000)
+    main.flush_dirty.start()
+    if main.ECONOMY_JOURNAL:
+        main.compact_journal.start()
+        await main.JOURNAL.compact()
+
+    cmd = {c.name: c for c in main.bot.tree.get_commands(guild=main.discord.Object(id=main.GUILD_ID))}
+    lottery_view = main.LotteryView()
+
+    def inter():
+        return FakeInteraction(members[rnd.choice(uids)], guild)
+
+    async def ev_on_message(i):
+        author = members[rnd.choice(uids)]
+        await main.on_message(FakeMessage(main.bot._connection, author, rnd.choice(channels), guild, "hello world"))
+        if i % 500 == 499:  # 模擬 xp_batch 週期
+            for channel, uid, lv in main.drain_message_xp():
+                main.OUTBOX.level_up(channel, uid, lv)
+
+    async def ev_work(i):
+        await cmd["work"].callback(inter(), questions=3)
+
+    async def ev_pay(i):
+        it = inter()
+        target = members[rnd.choice(uids)]
+        await cmd["pay"].callback(it, target=target, amount=5)
+        view = main.PayConfirmView(it.user.id, target.id, 5)
+        confirm = FakeInteraction(it.user, guild)
+        await view.children[0].callback(confirm)
+
+    async def ev_leaderboard(i):
+        await cmd["leaderboard"].callback(inter(), board="money")
+
+    async def ev_scratch(i):
+        await cmd["scratch"].callback(inter())
+
+    async def ev_lottery(i):
+        await lottery_view.children[0].callback(inter())
+
+    makers = {
+        "on_message": ev_on_message,
+        "work": ev_work,
+        "pay": ev_pay,
+        "leaderboard": ev_leaderboard,
+        "scratch": ev_scratch,
+        "lottery": ev_lottery,
+    }
+    results = []
+    for name in args.scenarios:
+        results.append(await run_scenario(main, name, makers[name], args.events, args.rate))
+    main.flush_dirty.cancel()
+    if main.ECONOMY_JOURNAL:
+        main.compact_journal.cancel()
+    return results
+
+
+def main_():
+    ap = argparse.ArgumentParser(description="離線壓力測試")
+    ap.add_argument("--users", type=int, default=5000)
+    ap.add_argument("--events", type=int, default=5000, help="每個情境觸發次數")
+    ap.add_argument("--rate", type=float, default=0, help="每秒事件數，0 = 不限速")
+    ap.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    ap.add_argument("--journal", choices=["0", "1"], default="1")
+    ap.add_argument("--user-cache", type=int, default=0, help="USER_CACHE_SIZE（需 --backend sqlite）")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    args = ap.parse_args()
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        ap.error(f"未知情境：{', '.join(sorted(unknown))}")
+
+    os.chdir(tempfile.mkdtemp(prefix="loadtest-"))
+    os.environ["STORAGE_BACKEND"] = args.backend
+    os.environ["ECONOMY_JOURNAL"] = args.journal
+    os.environ["USER_CACHE_SIZE"] = str(args.user_cache)
+    os.environ.setdefault("SLOW_HANDLER_THRESHOLD", "1")
+
+    results = asyncio.run(bench(args))
+    print(f"users={args.users} events={args.events} rate={args.rate or '不限'} backend={args.backend} "
+          f"journal={args.journal} user_cache={args.user_cache or '全部'}")
+    print(f"{'scenario':<12}{'ev/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'B/event':>10}{'RSS MB':>10}")
+    for r in results:
+        print(f"{r['scenario']:<12}{r['throughput']:>10.0f}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}"
+              f"{r['bytes_per_event']:>10.0f}{r['rss_mb']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main_()
@@ -1,43 +1,90 @@
 # main.py - 超完整整合版（Slash Command Tree / Render: PORT=8080）
 # 功能：
-# - 私訊轉發（兩按鈕：回覆 / 中斷對話；中斷時清除頻道中對話訊息、保留終止紀錄）
+# - 私訊轉發（兩按鈕：回覆 / 中斷對話；中斷時於背景 bulk delete 清除對話訊息、保留終止紀錄；會話持久化）
 # - /say （「某某某說：」）
-# - 經濟系統：/balance /profile /work（掃地/寫作業出題）/daily /pay(含確認) /shop /scratch /lottery
+# - 經濟系統（多帳戶交易：transaction() 帳戶鎖 + 一次寫入）：/balance /profile /work（掃地/寫作業出題）/daily /pay(含確認) /shop /scratch /lottery（count 一次買多張、獎項表資料化；/prize_sim 模擬期望值）
+# - 經濟統計：/economy_stats（管理；貨幣總量、前 1% 持有比例、等級分布、道具售出/持有、每日淨發行，異動時即時累計）
 # - 票務系統：/ticket 建立私有客訴頻道 + 關閉按鈕
-# - 等級：訊息給 XP，自動升級公告；/level 查看
-# - 列表與排行：/leaderboard
-# - 管理：/warn /warnings /reset_warnings /timeout（d/h/m/s + 原因）
-# - 權限：/grant_feature /revoke_feature（啟用一般使用者可用功能）
-# - 公告：/announce_admin（送到固定頻道）
+# - 等級：訊息給 XP（緩衝批次套用，XP_COOLDOWN 可設冷卻），自動升級公告；/level 查看
+# - 冷卻：/work /scratch /lottery 每人冷卻（WORK_COOLDOWN / SCRATCH_COOLDOWN / LOTTERY_COOLDOWN 秒），heap 清過期；/daily 存日號、跨日清掉舊紀錄
+# - 列表與排行：/leaderboard（money/xp/level）/rank（排序索引即時維護）
+# - 管理：/warn /warnings（分頁；結構化紀錄、舊警告封存成 gzip 段落）/reset_warnings /timeout（d/h/m/s + 原因）
+# - 批次管理：/bulk_feature /airdrop（金幣/票券/道具）/bulk_reset_warnings，對身分組或成員清單一次套用、一次寫入
+# - 權限：/grant_feature /revoke_feature（個人）、/grant_feature_role /revoke_feature_role（身分組）；權限檢查走記憶體快取，成員/身分組事件維護
+# - 公告：/announce_admin（送到該伺服器設定的公告頻道）
+# - 廣播：/broadcast_channels（多頻道公告）/broadcast_role（私訊身分組全員）；背景限速、重試、分段存檔可續送，
+#   完成後貼送達報告；/broadcast_status /broadcast_cancel
+# - 排程：/warn expires（警告到期自動移除）、限時道具（VIP卡 VIP_DAYS 天後收回）、/schedule_announce；
+#   持久化 min-heap，只睡到下一個到期時間，重啟後重建；/schedule_list /schedule_cancel
+# - 多伺服器：每個伺服器自己的管理身分組/公告頻道（/guild_config），經濟/XP/警告/權限資料依伺服器分開；
+#   AutoShardedBot（SHARD_COUNT / SHARD_IDS），python main.py --shard-groups N 把 shard 分給 N 個行程
 # - DM：/dm（管理員/擁有者可私訊任一成員）
+# - 訊息佇列：通知類訊息走 OUTBOX（每頻道限速、重試、升級公告合併）；/outbox_stats 查看
+# - 工作佇列：較慢的指令先 defer，工作交給 JOBS（JOB_WORKERS 個 worker、JOB_TIMEOUT 逾時），結果用 followup 回覆；/outbox_stats 一併顯示佇列深度
+# - 記憶體：LOW_MEMORY=1 不快取成員/訊息、名稱按需查詢（TTL 快取）；/memory 與 /metrics 回報 RSS 對成員數
 # - 機器人狀態：/set_status /reset_status（僅擁有者）+ 自動顯示服務人數
+# - 效能：所有指令/按鈕計時（含磁碟阻塞時間）、loop 卡住時印堆疊、/profiler（僅擁有者）取樣熱點
 # - 票券：/ticket_claim（按鈕領票），儲存在 users.json 的 tickets 欄位
 # - 娛樂：/coinflip /dice /8ball /truth /dare /joke
-# - Render Flask 保活：PORT 環境變數（預設 8080）
+# - 資料儲存：STORAGE_BACKEND=json|sqlite（WAL，單筆更新；python main.py --migrate-sqlite 搬移舊 JSON）；sqlite 下 USER_CACHE_SIZE 只留最近活躍的使用者紀錄在記憶體（LRU；排行索引仍涵蓋全部使用者）
+# - 資料寫入：write-behind（FLUSH_INTERVAL 秒或 FLUSH_MAX_CHANGES 筆變更合併寫檔，關機時補寫）
+# - 經濟 journal：異動逐筆 append 到 economy.journal，定期壓縮成快照，舊段落保留 JOURNAL_KEEP_DAYS 天供查帳（ECONOMY_JOURNAL=0 關閉）
+# - 啟動：資料讀取與登入並行；指令簽章沒變就不重新 sync；on_ready 印出各階段耗時
+# - HTTP（bot 內建 aiohttp，PORT 預設 8080，登入前就開始聽）：/ /healthz /readyz（資料載入且連上 gateway 才 200）/metrics（Prometheus）
+
+import time
+_IMPORT_START = time.perf_counter()
 
 import os
 import json
+import re
 import random
+import math
+import gzip
+import hashlib
+import heapq
+import bisect
+import signal
+import subprocess
+import sys
+import sqlite3
 import asyncio
+import weakref
 import threading
-from datetime import datetime, timedelta, timezone
-from typing import Dict, List
+import functools
+import itertools
+import traceback
+import contextvars
+import collections
+import contextlib
+from datetime import date, datetime, timedelta, timezone
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import MutableMapping
+from typing import Dict, List, Literal
 
 import discord
 from discord import app_commands
 from discord.ext import commands, tasks
-from flask import Flask
+from aiohttp import web
 
 # =========================
 # Configuration
 # =========================
-GUILD_ID = 1227929105018912839
+GUILD_ID = 1227929105018912839   # 主伺服器：指令在這裡定義、私訊轉發到這裡、舊資料屬於它
+# 以下三個是主伺服器的預設值；各伺服器實際設定存在 guilds store（/guild_config 修改）
 ADMIN_ROLE_ID = 1227938559130861578
 ANNOUNCE_CHANNEL_ID = 1228485979090718720
 DM_FORWARD_CHANNEL_ID = 1410490139297452042
 OWNER_ID = 1213418744685273100
 PORT = int(os.environ.get("PORT", 8080))
-DATA_DIR = "./data"
+DATA_DIR = os.environ.get("DATA_DIR", "./data")
+
+# Sharding：未設定時由 Discord 建議 shard 數、單一行程跑全部；
+# SHARD_COUNT + SHARD_IDS（例如 "0,1"）則只跑這幾個 shard，其他 shard group 由別的行程負責
+# （各自的 DATA_DIR 與 PORT；python main.py --shard-groups N 會自動分好並啟動）。
+SHARD_COUNT = int(os.environ["SHARD_COUNT"]) if os.environ.get("SHARD_COUNT") else None
+SHARD_IDS = [int(x) for x in os.environ.get("SHARD_IDS", "").split(",") if x.strip()] or None
 os.makedirs(DATA_DIR, exist_ok=True)
 
 # JSON files
@@ -45,11 +92,23 @@ USERS_FILE = os.path.join(DATA_DIR, "users.json")        # money/xp/level/ticket
 WARN_FILE = os.path.join(DATA_DIR, "warnings.json")      # warnings logs
 PERMS_FILE = os.path.join(DATA_DIR, "feature_perms.json")
 DAILY_FILE = os.path.join(DATA_DIR, "daily.json")
-
-# Token
+DM_SESSIONS_FILE = os.path.join(DATA_DIR, "dm_sessions.json")
+FEATURE_ROLES_FILE = os.path.join(DATA_DIR, "feature_roles.json")
+GUILDS_FILE = os.path.join(DATA_DIR, "guilds.json")
+ECON_STATS_FILE = os.path.join(DATA_DIR, "economy_stats.json")
+BROADCASTS_FILE = os.path.join(DATA_DIR, "broadcasts.json")
+SCHEDULE_FILE = os.path.join(DATA_DIR, "schedule.json")
+
+# Storage backend：json（預設，每個 store 一個檔）或 sqlite（WAL，單筆列更新）
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json").lower()
+SQLITE_FILE = os.path.join(DATA_DIR, "bot.db")
+# 使用者紀錄 LRU：最多留幾筆在記憶體（0 = 全部載入）；需要 sqlite（有索引、可單筆讀取）
+# 注意：只限制紀錄本身。排行索引（MONEY_INDEX / XP_INDEX）仍是每位使用者一筆，
+# 記憶體不會降到只跟活躍人數成正比（20 萬人約省 1/4）；/memory 會列出索引筆數。
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 0))
+
+# Token（實際啟動時才檢查，方便離線執行 migrate 等工具）
 TOKEN = os.environ.get("DISCORD_TOKEN")
-if not TOKEN:
-    raise RuntimeError("環境變數 DISCORD_TOKEN 未設定")
 
 # =========================
 # Helper functions for JSON
@@ -71,15 +130,1323 @@ def save_json(path, data):
     with open(path, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
-# load state
-USERS: Dict[str, dict] = load_json(USERS_FILE, {})
-WARNINGS: Dict[str, List[str]] = load_json(WARN_FILE, {})
-FEATURE_PERMS: Dict[str, bool] = load_json(PERMS_FILE, {})
-DAILY: Dict[str, str] = load_json(DAILY_FILE, {})
+# =========================
+# Metrics（Prometheus 文字格式）
+# =========================
+
+class Counter:
+    def __init__(self, name: str, help_: str):
+        self.name = name
+        self.help = help_
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, v in self.values.items():
+            out.append(f"{self.name}{_labels(key)} {v}")
+        return out
+
+
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help_: str, buckets: tuple = BUCKETS):
+        self.name = name
+        self.help = help_
+        self.buckets = buckets
+        # labels -> [每個 bucket 的累計數..., sum, count]
+        self.values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        row = self.values.get(key)
+        if row is None:
+            row = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        i = bisect.bisect_left(self.buckets, value)
+        for j in range(i, len(self.buckets)):
+            row[j] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, row in self.values.items():
+            for b, n in zip(self.buckets, row):
+                out.append(f"{self.name}_bucket{_labels(key + (('le', b),))} {n}")
+            out.append(f"{self.name}_bucket{_labels(key + (('le', '+Inf'),))} {row[-1]}")
+            out.append(f"{self.name}_sum{_labels(key)} {row[-2]}")
+            out.append(f"{self.name}_count{_labels(key)} {row[-1]}")
+        return out
+
+
+class Gauge:
+    """抓取時才呼叫 fn 取值。"""
+
+    def __init__(self, name: str, help_: str, fn):
+        self.name = name
+        self.help = help_
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.fn()}"]
+
+
+def _labels(key: tuple) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in key) + "}"
+
+
+METRICS: list = []
+
+
+def metric(m):
+    METRICS.append(m)
+    return m
+
+
+def render_metrics() -> str:
+    lines = []
+    for m in METRICS:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+COMMAND_LATENCY = metric(Histogram("bot_command_latency_seconds", "Slash command latency from interaction creation to completion"))
+FLUSH_SECONDS = metric(Histogram("bot_persist_flush_seconds", "Write-behind flush duration"))
+COMPACT_SECONDS = metric(Histogram("bot_journal_compact_seconds", "Economy journal compaction duration"))
+MESSAGES_TOTAL = metric(Counter("bot_messages_total", "Messages received"))
+
+# =========================
+# Profiling / slow handler detection
+# =========================
+# timed_handler：記錄每個指令/按鈕/事件的耗時，以及其中卡在同步磁碟 I/O（disk_io 區塊）的時間。
+# LoopWatchdog：另一條執行緒盯著 event loop 心跳，超過 SLOW_HANDLER_THRESHOLD 沒跳就印出 loop 目前的堆疊。
+SLOW_HANDLER_THRESHOLD = float(os.environ.get("SLOW_HANDLER_THRESHOLD", 0.25))   # 秒
 
-# 追蹤 DM 轉發會話：使用者 ID -> {"channel": int, "messages": [message_ids]}
+HANDLER_SECONDS = metric(Histogram("bot_handler_seconds", "Handler wall time"))
+HANDLER_DISK_SECONDS = metric(Histogram("bot_handler_disk_seconds", "Handler time blocked on synchronous disk I/O"))
+SLOW_HANDLERS = metric(Counter("bot_loop_stalls_total", "Event loop stalls longer than SLOW_HANDLER_THRESHOLD"))
+
+_DISK_ACC: contextvars.ContextVar = contextvars.ContextVar("disk_acc", default=None)
+LOOP_HEARTBEAT = time.monotonic()
+LOOP_THREAD_ID: int | None = None
+
+
+@contextlib.contextmanager
+def disk_io():
+    """包住在 event loop 上做的同步磁碟 I/O，時間算進目前的 handler。"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        acc = _DISK_ACC.get()
+        if acc is not None:
+            acc[0] += time.perf_counter() - start
+
+
+def timed_handler(name: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            acc = [0.0]
+            token = _DISK_ACC.set(acc)
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - start, handler=name)
+                HANDLER_DISK_SECONDS.observe(acc[0], handler=name)
+                _DISK_ACC.reset(token)
+        return wrapper
+    return deco
+
+
+class LoopWatchdog(threading.Thread):
+    def __init__(self, loop_thread_id: int, threshold: float):
+        super().__init__(name="loop-watchdog", daemon=True)
+        self.loop_thread_id = loop_thread_id
+        self.threshold = threshold
+
+    def run(self):
+        reported = False
+        while True:
+            time.sleep(self.threshold / 2)
+            stalled = time.monotonic() - LOOP_HEARTBEAT
+            if stalled <= self.threshold:
+                reported = False
+                continue
+            if reported:
+                continue
+            reported = True
+            SLOW_HANDLERS.inc()
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)[-15:]) if frame else '(無法取得)'
+            print(f"⚠️ event loop 已被佔用 {stalled:.2f}s，目前堆疊：\n{stack}", file=sys.stderr)
+
+
+def sample_stacks(thread_id: int, seconds: float, stop: threading.Event, interval: float = 0.005):
+    """取樣指定執行緒的堆疊，回傳 (最上層行數計數, 函式累計計數, 取樣數)。"""
+    own: collections.Counter = collections.Counter()
+    cum: collections.Counter = collections.Counter()
+    n = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end and not stop.is_set():
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            n += 1
+            code = frame.f_code
+            own[f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}"] += 1
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                key = f"{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}"
+                if key not in seen:
+                    seen.add(key)
+                    cum[key] += 1
+                frame = frame.f_back
+        time.sleep(interval)
+    return own, cum, n
+
+# =========================
+# Storage backends
+# =========================
+# 每個 backend 提供 load(name) -> dict 與 write(name, rows)；
+# rows 為 None 代表整個 store 重寫（payload = 整份資料），
+# 否則是 [(key, value 或 None=刪除)] 的單筆變更；replace=True 時 rows 是整份資料，不在裡面的 key 一併刪除。
+
+JSON_FILES = {
+    "users": USERS_FILE,
+    "warnings": WARN_FILE,
+    "feature_perms": PERMS_FILE,
+    "daily": DAILY_FILE,
+    "dm_sessions": DM_SESSIONS_FILE,
+    "feature_roles": FEATURE_ROLES_FILE,
+    "guilds": GUILDS_FILE,
+    "economy_stats": ECON_STATS_FILE,
+    "broadcasts": BROADCASTS_FILE,
+    "schedule": SCHEDULE_FILE,
+}
+
+
+class JsonBackend:
+    row_level = False
+
+    def __init__(self, files: Dict[str, str]):
+        self.files = files
+
+    def load(self, name: str) -> dict:
+        return load_json(self.files[name], {})
+
+    def write(self, name: str, payload: str, replace: bool = True):
+        path = self.files[name]
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp, path)
+
+
+class SqliteBackend:
+    row_level = True
+
+    def __init__(self, path: str):
+        # 只會被 flush 執行緒（一次一個）使用
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (store TEXT NOT NULL, k TEXT NOT NULL, v TEXT NOT NULL,"
+            " PRIMARY KEY (store, k)) WITHOUT ROWID"
+        )
+        self.conn.commit()
+        # event loop 上的單筆查詢（使用者快取 miss）用另一條連線，WAL 下不會和寫入互卡
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+
+    def load(self, name: str) -> dict:
+        cur = self.conn.execute("SELECT k, v FROM kv WHERE store = ?", (name,))
+        return {k: json.loads(v) for k, v in cur}
+
+    def get(self, name: str, k: str):
+        row = self.reader.execute("SELECT v FROM kv WHERE store = ? AND k = ?", (name, k)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def scan(self, name: str):
+        """逐筆讀出整個 store（不整份放進記憶體）。"""
+        for k, v in self.reader.execute("SELECT k, v FROM kv WHERE store = ?", (name,)):
+            yield k, json.loads(v)
+
+    def write(self, name: str, rows: List[tuple], replace: bool = False):
+        upserts = [(name, k, v) for k, v in rows if v is not None]
+        deletes = [(name, k) for k, v in rows if v is None]
+        with self.conn:
+            if replace:
+                # 同一個交易裡先清空再寫入：整份重寫時已刪掉的 key 不會殘留
+                self.conn.execute("DELETE FROM kv WHERE store = ?", (name,))
+            if upserts:
+                self.conn.executemany(
+                    "INSERT INTO kv (store, k, v) VALUES (?, ?, ?)"
+                    " ON CONFLICT (store, k) DO UPDATE SET v = excluded.v", upserts)
+            if deletes:
+                self.conn.executemany("DELETE FROM kv WHERE store = ? AND k = ?", deletes)
+
+
+def make_backend():
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteBackend(SQLITE_FILE)
+    return JsonBackend(JSON_FILES)
+
+
+def migrate_json_to_sqlite():
+    """一次性把 JSON 檔搬進 SQLite（python main.py --migrate-sqlite）。"""
+    src = JsonBackend(JSON_FILES)
+    dst = SqliteBackend(SQLITE_FILE)
+    for name in JSON_FILES:
+        data = src.load(name)
+        dst.write(name, [(k, json.dumps(v, ensure_ascii=False)) for k, v in data.items()])
+        print(f"✅ {name}: {len(data)} 筆")
+
+
+# =========================
+# Compact user store
+# =========================
+# 每位使用者一個 __slots__ 紀錄、以 int 為 key；道具 dict 用到才配置。
+# 支援 record['money'] / store['123'] 這類舊的 dict 寫法，指令程式碼不用改。
+
+class UserRecord:
+    __slots__ = ("money", "xp", "level", "tickets", "items")
+    FIELDS = ("money", "xp", "level", "tickets")
+
+    def __init__(self, money: int = 0, xp: int = 0, level: int = 1, tickets: int = 0, items: dict | None = None):
+        self.money = money
+        self.xp = xp
+        self.level = level
+        self.tickets = tickets
+        self.items = items or None
+
+    def __getitem__(self, key: str):
+        if key == "items":
+            if self.items is None:
+                self.items = {}
+            return self.items
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value):
+        if key != "items" and key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key: str, default=None):
+        if key == "items":
+            return self.items or default
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def to_dict(self) -> dict:
+        d = {"money": self.money, "xp": self.xp, "level": self.level, "tickets": self.tickets}
+        if self.items:
+            d["items"] = self.items
+        return d
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "UserRecord":
+        return cls(d.get("money", 0), d.get("xp", 0), d.get("level", 1), d.get("tickets", 0), d.get("items"))
+
+    def __repr__(self):
+        return f"UserRecord({self.to_dict()})"
+
+
+class UserStore(MutableMapping):
+    """uid（str 或 int 皆可）-> UserRecord；迭代時回傳 str uid 以相容舊程式。"""
+
+    def __init__(self, data: dict | None = None):
+        self._d: Dict[int, UserRecord] = {}
+        for k, v in (data or {}).items():
+            self[k] = v
+
+    def __getitem__(self, uid) -> UserRecord:
+        return self._d[int(uid)]
+
+    def __setitem__(self, uid, rec):
+        if not isinstance(rec, UserRecord):
+            rec = UserRecord.from_dict(rec)
+        self._d[int(uid)] = rec
+
+    def __delitem__(self, uid):
+        del self._d[int(uid)]
+
+    def __contains__(self, uid) -> bool:
+        return int(uid) in self._d
+
+    def __iter__(self):
+        return (str(k) for k in self._d)
+
+    def __len__(self):
+        return len(self._d)
+
+    def create(self, uid) -> UserRecord:
+        rec = self._d.get(int(uid))
+        if rec is None:
+            rec = self._d[int(uid)] = UserRecord()
+        return rec
+
+    def export(self) -> Dict[str, dict]:
+        return {str(k): r.to_dict() for k, r in self._d.items()}
+
+    def records(self):
+        """(str uid, 紀錄) 全部走一遍（建排行索引用）。"""
+        return ((str(k), r) for k, r in self._d.items())
+
+    def resident(self) -> int:
+        return len(self._d)
+
+    def peek(self, uid) -> UserRecord | None:
+        """只看記憶體、不影響 LRU 順序（write-behind 序列化用）。"""
+        return self._d.get(int(uid))
+
+    def resident_keys(self) -> List[str]:
+        return [str(k) for k in self._d]
+
+    def removed(self, uid) -> bool:
+        """peek 找不到時：是真的被刪掉（要刪資料列），還是只是不在記憶體。"""
+        return True
+
+    # 以下給 CachedUserStore 用；全部在記憶體時不需要做事
+    lazy = False
+
+    def touch(self, uid):
+        pass
+
+    def taken(self, keys):
+        pass
+
+    def written(self, keys):
+        pass
+
+    def failed(self, keys):
+        pass
+
+
+USER_CACHE = metric(Counter("bot_user_cache_total", "User record cache lookups"))
+
+
+class CachedUserStore(UserStore):
+    """只留最近用到的 capacity 筆在記憶體（LRU），其他在 backend（SQLite 主鍵索引，單筆讀取）。
+    改過的紀錄（touch）被擠出時先放到 evicted 並標記 write-behind，寫進去之後才真的丟掉；
+    沒改過的直接丟。
+    排行索引與經濟統計不在這裡，啟動時仍會掃過全部紀錄、每人留一筆索引。"""
+
+    lazy = True
+
+    def __init__(self, backend, capacity: int):
+        super().__init__()
+        self._d: collections.OrderedDict = collections.OrderedDict()
+        self.backend = backend
+        self.capacity = capacity
+        self.dirty: set = set()                       # 改過、還沒交給 write-behind 的 key
+        self.evicted: Dict[int, UserRecord] = {}      # 擠出去但還沒寫回
+        self.inflight: Dict[int, UserRecord] = {}     # 已序列化、寫入中
+        self.deleted: set = set()                     # 刪掉、還沒寫回的 key
+
+    def _fetch(self, key: int) -> UserRecord | None:
+        rec = self._d.get(key)
+        if rec is not None:
+            self._d.move_to_end(key)
+            USER_CACHE.inc(result="hit")
+            return rec
+        USER_CACHE.inc(result="miss")
+        rec = self.evicted.pop(key, None) or self.inflight.get(key)
+        if rec is None:
+            with disk_io():
+                raw = self.backend.get("users", str(key))
+            if raw is None:
+                return None
+            rec = UserRecord.from_dict(raw)
+        self._admit(key, rec)
+        return rec
+
+    def _admit(self, key: int, rec: UserRecord):
+        self.deleted.discard(key)
+        self._d[key] = rec
+        while len(self._d) > self.capacity:
+            old, old_rec = self._d.popitem(last=False)
+            if old in self.dirty:
+                self.evicted[old] = old_rec
+                mark_dirty("users", str(old))
+
+    def __getitem__(self, uid) -> UserRecord:
+        rec = self._fetch(int(uid))
+        if rec is None:
+            raise KeyError(uid)
+        return rec
+
+    def __setitem__(self, uid, rec):
+        if not isinstance(rec, UserRecord):
+            rec = UserRecord.from_dict(rec)
+        self.dirty.add(int(uid))
+        self._admit(int(uid), rec)
+
+    def __delitem__(self, uid):
+        key = int(uid)
+        self._d.pop(key, None)
+        self.evicted.pop(key, None)
+        self.dirty.discard(key)
+        self.deleted.add(key)
+        mark_dirty("users", str(key))
+
+    def __contains__(self, uid) -> bool:
+        return self._fetch(int(uid)) is not None
+
+    def peek(self, uid) -> UserRecord | None:
+        key = int(uid)
+        return self._d.get(key) or self.evicted.get(key) or self.inflight.get(key)
+
+    def resident_keys(self) -> List[str]:
+        return [str(k) for k in self._d.keys() | self.evicted.keys() | self.inflight.keys() | self.deleted]
+
+    def removed(self, uid) -> bool:
+        return int(uid) in self.deleted
+
+    def _all_keys(self) -> set:
+        keys = {int(k) for k, _ in self.backend.scan("users")}
+        return keys | self._d.keys() | self.evicted.keys() | self.inflight.keys()
+
+    def __iter__(self):
+        return (str(k) for k in self._all_keys())
+
+    def __len__(self):
+        return len(self._all_keys())
+
+    def create(self, uid) -> UserRecord:
+        key = int(uid)
+        rec = self._fetch(key)
+        if rec is None:
+            rec = UserRecord()
+            self._admit(key, rec)
+        self.dirty.add(key)
+        return rec
+
+    def records(self):
+        overlay = {**self.inflight, **self.evicted, **self._d}
+        for k, raw in self.backend.scan("users"):
+            rec = overlay.pop(int(k), None)
+            yield k, rec or UserRecord.from_dict(raw)
+        for k, rec in overlay.items():
+            yield str(k), rec
+
+    def touch(self, uid):
+        self.dirty.add(int(uid))
+
+    def taken(self, keys):
+        """write-behind 已序列化這些 key：之後再改才算 dirty；擠出去的移到寫入中。"""
+        for k in keys:
+            key = int(k)
+            self.dirty.discard(key)
+            self.deleted.discard(key)
+            rec = self.evicted.pop(key, None)
+            if rec is not None:
+                self.inflight[key] = rec
+
+    def written(self, keys):
+        for k in keys:
+            self.inflight.pop(int(k), None)
+
+    def failed(self, keys):
+        """寫入失敗：恢復成 taken 之前的狀態（仍是 dirty，擠出去的回到 evicted）。"""
+        for k in keys:
+            key = int(k)
+            rec = self.inflight.pop(key, None)
+            if key in self._d:
+                self.dirty.add(key)
+            elif rec is not None:
+                self.dirty.add(key)
+                self.evicted.setdefault(key, rec)
+            else:
+                self.deleted.add(key)   # 寫入的是刪除
+
+
+BACKEND = make_backend()
+
+# state（實際讀檔在 load_state()，啟動時與登入並行，不卡 import）
+if USER_CACHE_SIZE and BACKEND.row_level:
+    USERS: UserStore = CachedUserStore(BACKEND, USER_CACHE_SIZE)
+else:
+    if USER_CACHE_SIZE:
+        print("⚠️ USER_CACHE_SIZE 需要 STORAGE_BACKEND=sqlite，使用者紀錄仍全部放在記憶體")
+    USERS = UserStore()
+WARNINGS: Dict[str, List[dict]] = {}   # uid -> [{"ts", "mod", "reason"}]（依時間）
+FEATURE_PERMS: Dict[str, bool] = {}
+DAILY: Dict[str, int] = {}          # uid -> 最後領取的日號（UTC，1970-01-01 起算的天數）
+
+# 追蹤 DM 轉發會話：使用者 ID -> {"channel": int, "messages": [message_ids], "views": [[按鈕訊息 ID, 轉發紀錄 ID]]}
+# 會持久化，重啟後按鈕仍可用、中斷時也清得掉重啟前的訊息
 DM_SESSIONS: Dict[int, dict] = {}
 
+# 廣播：id -> {"kind", "guild", "by", "report", "content", "targets", "cursor", "counts", "done"}（見 Broadcasts）
+BROADCASTS: Dict[str, dict] = {}
+
+# 排程動作：id -> {"at": epoch 秒, "kind", "slot", "args"}（見 Scheduler）
+SCHEDULE: Dict[str, dict] = {}
+
+# 權限快取（load_state / on_ready 建立，事件維護）
+FEATURE_USERS: set = set()         # 個別開通的成員 key（FEATURE_PERMS 的 int 版）
+FEATURE_ROLES: set = set()         # 整個身分組開通的 role id（持久化；role id 全域唯一）
+FEATURE_ROLE_MEMBERS: Dict[int, set] = {}  # guild id -> 擁有任一開通身分組的 user id
+ADMIN_MEMBERS: Dict[int, set] = {}         # guild id -> 該伺服器管理員的 user id
+PERM_CACHE_READY: set = set()              # 已建好快取的 guild id
+
+# =========================
+# Guild partitions
+# =========================
+# 每個伺服器一個 slot（主伺服器固定 0）。經濟/XP/警告/權限資料的 key 是 slot << 64 | user id，
+# 主伺服器的 key 就是原本的 user id，舊資料不用搬；其他伺服器自然分開，store 與 backend 都不用改。
+USER_BITS = 64
+USER_MASK = (1 << USER_BITS) - 1
+
+# guild id -> {"slot", "admin_role", "announce_channel", "dm_forward_channel"[, "left": 離開時間]}
+# 離開的伺服器只標記 left（slot 不能給別的伺服器重用，否則會接手舊資料）；重新加入時清掉
+GUILD_CONFIGS: Dict[int, dict] = {}
+
+
+def register_guild(guild_id: int) -> dict:
+    conf = GUILD_CONFIGS.get(guild_id)
+    if conf is None:
+        if guild_id == GUILD_ID:
+            conf = {"slot": 0, "admin_role": ADMIN_ROLE_ID, "announce_channel": ANNOUNCE_CHANNEL_ID,
+                    "dm_forward_channel": DM_FORWARD_CHANNEL_ID}
+        else:
+            slot = max((c["slot"] for c in GUILD_CONFIGS.values()), default=0) + 1
+            conf = {"slot": slot, "admin_role": 0, "announce_channel": 0, "dm_forward_channel": 0}
+        GUILD_CONFIGS[guild_id] = conf
+        mark_dirty('guilds', str(guild_id))
+    elif conf.pop("left", None) is not None:
+        mark_dirty('guilds', str(guild_id))
+    return conf
+
+
+def forget_guild(guild_id: int):
+    """機器人已不在這個伺服器：不再同步指令；資料與 slot 保留。"""
+    conf = GUILD_CONFIGS.get(guild_id)
+    if conf is None or "left" in conf or guild_id == GUILD_ID:
+        return
+    conf["left"] = int(time.time())
+    mark_dirty('guilds', str(guild_id))
+    state = load_json(SYNC_STATE_FILE, {})
+    if state.pop(str(guild_id), None) is not None:
+        save_json(SYNC_STATE_FILE, state)
+
+
+def guild_conf(guild_id: int | None) -> dict:
+    return register_guild(GUILD_ID if guild_id is None else guild_id)
+
+
+def guild_slot(guild_id: int | None) -> int:
+    return guild_conf(guild_id)["slot"]
+
+
+def member_key(guild_id: int | None, user_id: int) -> str:
+    """成員在某伺服器的資料 key（私訊等沒有伺服器的情境算主伺服器）。"""
+    return str(guild_slot(guild_id) << USER_BITS | user_id)
+
+
+def key_user(key) -> int:
+    return int(key) & USER_MASK
+
+
+def key_slot(key) -> int:
+    return int(key) >> USER_BITS
+
+
+def shard_of_count(guild_id: int, count: int) -> int:
+    return (guild_id >> 22) % count
+
+
+def local_guilds() -> List[int]:
+    """本行程負責的伺服器（有指定 SHARD_IDS 時只取自己 shard 上的）。"""
+    gids = [gid for gid, conf in GUILD_CONFIGS.items() if "left" not in conf]
+    if SHARD_IDS and SHARD_COUNT:
+        return [gid for gid in gids if shard_of_count(gid, SHARD_COUNT) in SHARD_IDS]
+    return gids
+
+
+class PerGuild(dict):
+    """slot -> 索引，第一次用到才建立。"""
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, slot: int):
+        value = self[slot] = self.factory()
+        return value
+
+# =========================
+# Write-behind persistence
+# =========================
+# 變更只標記 dirty（store 或 store 內的單筆 key），由背景迴圈合併後寫入；
+# 累積變更數達上限時提早寫入。
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", 15))       # 秒
+FLUSH_MAX_CHANGES = int(os.environ.get("FLUSH_MAX_CHANGES", 500))
+
+# store 名稱 -> 取得目前資料的函式
+STORES = {
+    "users": lambda: USERS,
+    "warnings": lambda: WARNINGS,
+    "feature_perms": lambda: FEATURE_PERMS,
+    "daily": lambda: DAILY,
+    "dm_sessions": lambda: {str(k): v for k, v in DM_SESSIONS.items()},
+    "feature_roles": lambda: {str(r): True for r in FEATURE_ROLES},
+    "guilds": lambda: {str(k): v for k, v in GUILD_CONFIGS.items()},
+    "economy_stats": lambda: {str(slot): st.persisted() for slot, st in ECON_STATS.items()},
+    "broadcasts": lambda: BROADCASTS,
+    "schedule": lambda: SCHEDULE,
+}
+
+
+class WriteBehind:
+    def __init__(self, backend, stores: dict, max_changes: int):
+        self.backend = backend
+        self.stores = stores
+        self.max_changes = max_changes
+        # store -> dirty keys；None 代表整個 store
+        self.dirty: Dict[str, set | None] = {}
+        self.pending = 0
+        self._digests: Dict[str, int] = {}
+        self._lock = asyncio.Lock()
+        self._flushing = False
+
+    def mark(self, name: str, *keys: str):
+        if not keys or not self.backend.row_level:
+            self.dirty[name] = None
+        elif self.dirty.get(name, set()) is not None:
+            self.dirty.setdefault(name, set()).update(keys)
+        self.pending += 1
+        if self.pending >= self.max_changes and not self._flushing:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush()   # 沒有 event loop（離線工具、關機路徑）就同步寫
+            else:
+                spawn(self.flush_async())
+
+    def _take(self) -> List[tuple]:
+        """取出 dirty 資料並序列化（在 event loop 執行緒上做，避免資料被同時修改）。
+        每筆是 (store, payload, replace, 取出的 dirty keys, JSON 內容 digest)；寫入失敗時用來放回。"""
+        dirty, self.dirty, self.pending = self.dirty, {}, 0
+        out = []
+        for name, keys in dirty.items():
+            data = self.stores[name]()
+            if not self.backend.row_level:
+                if isinstance(data, UserStore):
+                    data = data.export()
+                text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+                digest = hash(text)
+                if self._digests.get(name) == digest:
+                    continue  # 內容沒變就不寫
+                out.append((name, text, True, keys, digest))
+                continue
+            # 快取模式的 users 只有部分在記憶體，不能當成整份資料
+            replace = keys is None and not (isinstance(data, UserStore) and data.lazy)
+            if isinstance(data, UserStore):
+                # 不經過 __getitem__：序列化不該把擠出去的紀錄放回 LRU，也不算快取查詢
+                rows = []
+                for k in (data.resident_keys() if keys is None else keys):
+                    rec = data.peek(k)
+                    if rec is not None:
+                        rows.append((k, json.dumps(rec.to_dict(), ensure_ascii=False, separators=(",", ":"))))
+                    elif data.removed(k):
+                        rows.append((k, None))
+                    # 其他：已經寫回並擠出去了，資料庫裡就是最新的
+                data.taken(k for k, _ in rows)
+            else:
+                rows = [(k, json.dumps(data[k], ensure_ascii=False, separators=(",", ":"))
+                         if k in data else None)
+                        for k in (data.keys() if keys is None else keys)]
+            out.append((name, rows, replace, keys, None))
+        return out
+
+    def _write(self, batch: List[tuple]):
+        for name, payload, replace, _, _ in batch:
+            self.backend.write(name, payload, replace)
+
+    def _written(self, batch: List[tuple]):
+        for name, payload, _, _, digest in batch:
+            if digest is not None:
+                self._digests[name] = digest
+            data = self.stores[name]()
+            if isinstance(data, UserStore) and self.backend.row_level:
+                data.written(k for k, _ in payload)
+
+    def _failed(self, batch: List[tuple]):
+        """寫入失敗：把取出的 dirty 放回去，下一輪重試（寫到一半的 store 整份/同一批 key 再寫一次）。"""
+        for name, payload, _, keys, _ in batch:
+            if keys is None or not self.backend.row_level:
+                self.dirty[name] = None
+            elif self.dirty.get(name, set()) is not None:
+                self.dirty.setdefault(name, set()).update(keys)
+            data = self.stores[name]()
+            if isinstance(data, UserStore) and self.backend.row_level:
+                data.failed(k for k, _ in payload)
+            self.pending += 1
+
+    async def flush_async(self):
+        async with self._lock:
+            self._flushing = True
+            try:
+                batch = self._take()
+                if batch:
+                    start = time.perf_counter()
+                    try:
+                        await asyncio.to_thread(self._write, batch)
+                    except Exception:
+                        self._failed(batch)
+                        raise
+                    self._written(batch)
+                    FLUSH_SECONDS.observe(time.perf_counter() - start)
+            finally:
+                self._flushing = False
+
+    def flush(self):
+        """同步寫入（關機時使用）。"""
+        batch = self._take()
+        try:
+            self._write(batch)
+        except Exception:
+            self._failed(batch)
+            raise
+        self._written(batch)
+
+
+PERSIST = WriteBehind(BACKEND, STORES, FLUSH_MAX_CHANGES)
+
+
+def mark_dirty(store: str, *keys: str):
+    PERSIST.mark(store, *keys)
+
+
+@tasks.loop(seconds=FLUSH_INTERVAL)
+async def flush_dirty():
+    mark_stats_dirty()
+    try:
+        await PERSIST.flush_async()
+    except Exception as e:
+        # 變更已放回 dirty，下一輪重試；不要讓例外停掉這個 loop
+        print(f"⚠️ 寫入資料失敗，稍後重試：{e!r}")
+
+# =========================
+# Economy journal（append-only）
+# =========================
+# 每筆金錢/XP/票券/道具異動寫成一行事件（含異動後的狀態，重播可重複執行）；
+# compactor 定期把 journal 折進 users 快照，舊段落移到 JOURNAL_ARCHIVE_DIR 當稽核紀錄。
+ECONOMY_JOURNAL = os.environ.get("ECONOMY_JOURNAL", "1") == "1"
+JOURNAL_FILE = os.path.join(DATA_DIR, "economy.journal")
+JOURNAL_ARCHIVE_DIR = os.path.join(DATA_DIR, "journal")
+# 封存段落保留天數（轉帳爭議查帳用）；0 = 永不刪除
+JOURNAL_KEEP_DAYS = float(os.environ.get("JOURNAL_KEEP_DAYS", 365))
+COMPACT_INTERVAL = float(os.environ.get("COMPACT_INTERVAL", 10))      # 分鐘
+COMPACT_MAX_EVENTS = int(os.environ.get("COMPACT_MAX_EVENTS", 20000))
+
+
+class EconomyJournal:
+    def __init__(self, path: str, archive_dir: str):
+        self.path = path
+        self.archive_dir = archive_dir
+        self.seq = 0
+        self.count = 0            # 目前段落的事件數
+        self.touched: set = set() # 快照後被改過的 uid
+        self._f = None
+        self._lock = asyncio.Lock()
+
+    def replay(self, users: UserStore) -> int:
+        """啟動時把尚未壓縮的段落（.old 與目前檔案）套到快照上。"""
+        if os.path.isdir(self.archive_dir):
+            # 序號接續最後一個封存段落（檔名結尾 -<seq>.jsonl）
+            for name in os.listdir(self.archive_dir):
+                self.seq = max(self.seq, int(name.rsplit("-", 1)[1].split(".")[0]))
+        n = 0
+        for path in (self.path + ".old", self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        ev = json.loads(line)
+                    except ValueError:
+                        break  # 最後一行寫到一半就當機
+                    u = users.create(ev["uid"])
+                    users.touch(ev["uid"])
+                    u.money, u.xp, u.level, u.tickets = ev["bal"]
+                    if "item" in ev:
+                        name, _, count = ev["item"]
+                        if count > 0:
+                            u["items"][name] = count
+                        else:
+                            u["items"].pop(name, None)   # 和 _econ_mutate 一樣，數量歸零就移除
+                    self.seq = max(self.seq, ev["seq"])
+                    self.touched.add(ev["uid"])
+                    n += 1
+        return n
+
+    def open(self):
+        self._f = open(self.path, "a", encoding="utf-8")
+
+    def append(self, *events: dict):
+        """寫入一或多筆事件（同一交易的事件一次寫出）。"""
+        lines = []
+        for ev in events:
+            self.seq += 1
+            ev["seq"] = self.seq
+            lines.append(json.dumps(ev, ensure_ascii=False, separators=(",", ":")) + "\n")
+            self.touched.add(ev["uid"])
+        with disk_io():
+            self._f.write("".join(lines))
+            self._f.flush()
+        self.count += len(events)
+        if self.count >= COMPACT_MAX_EVENTS and not self._lock.locked():
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return   # 關機路徑（asyncio.run 已結束）：隨後會 compact_sync
+            spawn(self.compact())
+
+    def _rotate(self):
+        self._f.close()
+        old = self.path + ".old"
+        if os.path.exists(old):
+            # 上一次壓縮沒完成：接在舊段落後面，一起處理
+            with open(old, "a", encoding="utf-8") as dst, open(self.path, "r", encoding="utf-8") as src:
+                dst.write(src.read())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, old)
+        self.open()
+        touched, self.touched, self.count = self.touched, set(), 0
+        return touched
+
+    def _archive_old(self):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        name = datetime.utcnow().strftime("%Y%m%dT%H%M%S") + f"-{self.seq}.jsonl"
+        os.replace(self.path + ".old", os.path.join(self.archive_dir, name))
+        if JOURNAL_KEEP_DAYS <= 0:
+            return
+        # 段落檔名開頭是封存時間（UTC）
+        cutoff = (datetime.utcnow() - timedelta(days=JOURNAL_KEEP_DAYS)).strftime("%Y%m%dT%H%M%S")
+        for old in os.listdir(self.archive_dir):
+            if old.split("-", 1)[0] < cutoff:
+                os.remove(os.path.join(self.archive_dir, old))
+
+    async def compact(self):
+        async with self._lock:
+            if self.count == 0 and not os.path.exists(self.path + ".old"):
+                return
+            start = time.perf_counter()
+            touched = self._rotate()
+            if touched:
+                mark_dirty("users", *touched)
+            try:
+                await PERSIST.flush_async()
+            except Exception:
+                # 快照沒寫成：這些使用者跟著 .old 留到下一次壓縮，.old 也不能封存
+                self.touched |= touched
+                raise
+            await asyncio.to_thread(self._archive_old)
+            COMPACT_SECONDS.observe(time.perf_counter() - start)
+
+    def compact_sync(self):
+        """啟動重播後 / 關機時使用：直接把目前狀態寫成快照。"""
+        if self._f is None:
+            self.open()
+        touched = self._rotate()
+        if touched:
+            mark_dirty("users", *touched)
+        try:
+            PERSIST.flush()
+        except Exception:
+            self.touched |= touched
+            raise
+        self._archive_old()
+
+
+JOURNAL = EconomyJournal(JOURNAL_FILE, JOURNAL_ARCHIVE_DIR)
+
+
+@tasks.loop(minutes=COMPACT_INTERVAL)
+async def compact_journal():
+    try:
+        await JOURNAL.compact()
+    except Exception as e:
+        print(f"⚠️ journal 壓縮失敗，下次再試：{e!r}")
+
+# =========================
+# Leaderboard index
+# =========================
+# 依分數排序的 (-score, uid) 清單，用 bisect 維護：
+# 前 N 名 O(N)、查名次 O(log n)；異動時只移動該使用者一筆。
+
+class RankIndex:
+    def __init__(self):
+        self.keys: List[tuple] = []       # 由高到低：(-score, uid)
+        self.score: Dict[int, int] = {}
+
+    def update(self, uid: int, score: int):
+        old = self.score.get(uid)
+        if old == score:
+            return
+        if old is not None:
+            del self.keys[bisect.bisect_left(self.keys, (-old, uid))]
+        bisect.insort(self.keys, (-score, uid))
+        self.score[uid] = score
+
+    def remove(self, uid: int):
+        old = self.score.pop(uid, None)
+        if old is not None:
+            del self.keys[bisect.bisect_left(self.keys, (-old, uid))]
+
+    def top(self, n: int) -> List[tuple]:
+        return [(uid, -neg) for neg, uid in self.keys[:n]]
+
+    def rank(self, uid: int) -> int | None:
+        """名次（1 起算）；不在榜上回傳 None。"""
+        score = self.score.get(uid)
+        if score is None:
+            return None
+        return bisect.bisect_left(self.keys, (-score, uid)) + 1
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def total_xp(u: dict) -> int:
+    """累積 XP（升到 L 級共需 50*L*(L-1)）。等級榜與 XP 榜共用這個排序。"""
+    return 50 * u['level'] * (u['level'] - 1) + u['xp']
+
+
+# 每個伺服器各自一份排行
+MONEY_INDEX = PerGuild(RankIndex)
+XP_INDEX = PerGuild(RankIndex)
+
+
+def index_user(uid: str, u: UserRecord | None = None):
+    if u is None:
+        u = USERS[uid]
+    slot = key_slot(uid)
+    MONEY_INDEX[slot].update(int(uid), u['money'])
+    XP_INDEX[slot].update(int(uid), total_xp(u))
+
+
+# =========================
+# Economy aggregates
+# =========================
+# 每次經濟異動（_econ_mutate）順便更新，/economy_stats 直接讀，不用掃 USERS。
+# 貨幣總量、等級分布、持有道具數可從使用者資料重算（啟動時建索引那一輪順便算）；
+# 每日淨發行與商店售出數算不回來，另存在 economy_stats store（每個 flush 週期寫一次）。
+ISSUANCE_KEEP_DAYS = 30
+
+
+class EconomyStats:
+    def __init__(self):
+        self.users = 0
+        self.money = 0
+        self.levels: Dict[int, int] = {}
+        self.items: Dict[str, int] = {}
+        self.sold: Dict[str, int] = {}
+        self.issuance: Dict[int, Dict[str, int]] = {}   # 日號 -> reason -> 淨發行金幣
+        self.changed = False
+
+    def add_user(self, u: UserRecord):
+        self.users += 1
+        self.money += u.money
+        self.levels[u.level] = self.levels.get(u.level, 0) + 1
+        for item, n in (u.items or {}).items():
+            self.items[item] = self.items.get(item, 0) + n
+
+    def apply(self, reason: str, money: int, old_level: int, new_level: int, item: str | None, qty: int):
+        if money:
+            self.money += money
+            today = day_number()
+            day = self.issuance.get(today)
+            if day is None:
+                day = self.issuance[today] = {}
+                for old in [d for d in self.issuance if d <= today - ISSUANCE_KEEP_DAYS]:
+                    del self.issuance[old]
+            day[reason] = day.get(reason, 0) + money
+            self.changed = True
+        if new_level != old_level:
+            self.levels[old_level] -= 1
+            if not self.levels[old_level]:
+                del self.levels[old_level]
+            self.levels[new_level] = self.levels.get(new_level, 0) + 1
+        if item:
+            self.items[item] = self.items.get(item, 0) + qty
+            if reason == 'shop' and qty > 0:
+                self.sold[item] = self.sold.get(item, 0) + qty
+                self.changed = True
+
+    def persisted(self) -> dict:
+        return {"sold": self.sold, "issuance": {str(d): v for d, v in self.issuance.items()}}
+
+    def restore(self, raw: dict):
+        self.sold = dict(raw.get("sold", {}))
+        self.issuance = {int(d): v for d, v in raw.get("issuance", {}).items()}
+
+
+ECON_STATS = PerGuild(EconomyStats)
+
+
+def mark_stats_dirty():
+    changed = [str(slot) for slot, st in ECON_STATS.items() if st.changed]
+    for slot in changed:
+        ECON_STATS[int(slot)].changed = False
+    if changed:
+        mark_dirty('economy_stats', *changed)
+
+
+# =========================
+# Moderation warnings
+# =========================
+# 每筆警告是 {"ts": epoch 秒, "mod": 管理員 ID, "reason": 原因}，依使用者存在 WARNINGS；
+# WARN_INDEX 另外依時間排序各伺服器的紀錄（最近警告列表、找出要封存的舊紀錄都是 O(log n)）。
+# 超過 WARN_HOT_DAYS 天的紀錄定期移到 WARN_ARCHIVE_DIR 的 gzip 段落（每月一檔），熱資料檔保持小。
+WARN_ARCHIVE_DIR = os.path.join(DATA_DIR, "warnings_archive")
+WARN_HOT_DAYS = float(os.environ.get("WARN_HOT_DAYS", 180))
+
+
+def _warn_ts(entry: tuple) -> int:
+    return entry[1]["ts"]
+
+
+class WarnIndex:
+    def __init__(self):
+        self.entries: List[tuple] = []   # (uid, 紀錄)，依 ts 排序
+
+    def rebuild(self, warnings: Dict[str, List[dict]]):
+        self.entries = sorted(((uid, rec) for uid, recs in warnings.items() for rec in recs), key=_warn_ts)
+
+    def add(self, uid: str, rec: dict):
+        bisect.insort(self.entries, (uid, rec), key=_warn_ts)
+
+    def remove_users(self, uids: set):
+        self.entries = [e for e in self.entries if e[0] not in uids]
+
+    def recent(self, offset: int, n: int) -> List[tuple]:
+        end = len(self.entries) - offset
+        return self.entries[max(0, end - n):max(0, end)][::-1]
+
+    def remove(self, uid: str, rec: dict):
+        i = bisect.bisect_left(self.entries, rec["ts"], key=_warn_ts)
+        while i < len(self.entries) and self.entries[i][1]["ts"] == rec["ts"]:
+            if self.entries[i][1] is rec:
+                del self.entries[i]
+                return
+            i += 1
+
+    def pop_before(self, ts: int) -> List[tuple]:
+        i = bisect.bisect_left(self.entries, ts, key=_warn_ts)
+        old, self.entries = self.entries[:i], self.entries[i:]
+        return old
+
+    def __len__(self):
+        return len(self.entries)
+
+
+WARN_INDEX = PerGuild(WarnIndex)
+
+
+def index_warnings():
+    WARN_INDEX.clear()
+    by_slot: Dict[int, dict] = {}
+    for uid, recs in WARNINGS.items():
+        by_slot.setdefault(key_slot(uid), {})[uid] = recs
+    for slot, warnings in by_slot.items():
+        WARN_INDEX[slot].rebuild(warnings)
+
+
+def load_warnings(raw: dict) -> Dict[str, List[dict]]:
+    """讀入 warnings store；舊格式字串「時間 - 原因 - by 名稱」轉成結構化紀錄。"""
+    out, changed = {}, False
+    for uid, logs in raw.items():
+        recs = []
+        for item in logs:
+            if isinstance(item, str):
+                item = parse_legacy_warning(item)
+                changed = True
+            recs.append(item)
+        if recs:
+            out[uid] = sorted(recs, key=lambda r: r["ts"])
+    if changed:
+        PERSIST.mark('warnings')
+    return out
+
+
+def parse_legacy_warning(text: str) -> dict:
+    head, _, by = text.rpartition(" - by ")
+    if not head:
+        head, by = text, ""
+    stamp, _, reason = head.partition(" - ")
+    try:
+        ts = int(datetime.strptime(stamp, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp())
+    except ValueError:
+        ts, reason = 0, text
+    rec = {"ts": ts, "mod": 0, "reason": reason}
+    if by:
+        rec["by"] = by   # 舊紀錄只有管理員名稱
+    return rec
+
+
+def add_warning(uid: str, mod: int, reason: str, expires: int = 0) -> int:
+    """新增一筆警告（expires 秒後自動移除，0 = 不過期），回傳該使用者目前（未封存）的警告數。"""
+    rec = {"ts": int(time.time()), "mod": mod, "reason": reason}
+    if expires:
+        rec["exp"] = rec["ts"] + expires
+        SCHEDULER.add("warn_expire", rec["exp"], key_slot(uid), uid=uid, ts=rec["ts"], mod=mod)
+    WARNINGS.setdefault(uid, []).append(rec)
+    WARN_INDEX[key_slot(uid)].add(uid, rec)
+    mark_dirty('warnings', uid)
+    return len(WARNINGS[uid])
+
+
+def expire_warning(uid: str, ts: int, mod: int) -> bool:
+    """移除一筆到期的警告（已被重置或封存就什麼都不做）。"""
+    recs = WARNINGS.get(uid, [])
+    for rec in recs:
+        if rec["ts"] == ts and rec["mod"] == mod:
+            recs.remove(rec)
+            WARN_INDEX[key_slot(uid)].remove(uid, rec)
+            if not recs:
+                del WARNINGS[uid]
+            mark_dirty('warnings', uid)
+            return True
+    return False
+
+
+def clear_warnings(*uids: str) -> int:
+    """清除一或多人的警告（索引每個伺服器只重建一次），回傳實際有紀錄的人數。"""
+    cleared = [uid for uid in uids if WARNINGS.pop(uid, None)]
+    by_slot: Dict[int, set] = {}
+    for uid in cleared:
+        by_slot.setdefault(key_slot(uid), set()).add(uid)
+    for slot, keys in by_slot.items():
+        WARN_INDEX[slot].remove_users(keys)
+    if cleared:
+        mark_dirty('warnings', *cleared)
+    return len(cleared)
+
+
+def _write_warn_segments(old: List[tuple]):
+    os.makedirs(WARN_ARCHIVE_DIR, exist_ok=True)
+    by_month: Dict[str, List[str]] = {}
+    for uid, rec in old:
+        month = datetime.fromtimestamp(rec["ts"], timezone.utc).strftime("%Y%m")
+        by_month.setdefault(month, []).append(json.dumps({"uid": uid, **rec}, ensure_ascii=False) + "\n")
+    with disk_io():
+        for month, lines in by_month.items():
+            # gzip 以附加方式寫入會多一個 member，讀的時候 gzip.open 會接起來
+            with gzip.open(os.path.join(WARN_ARCHIVE_DIR, f"warnings-{month}.jsonl.gz"), "at", encoding="utf-8") as f:
+                f.writelines(lines)
+
+
+def read_archived_warnings(uid: str) -> List[dict]:
+    """從封存段落找出某使用者的舊警告（管理指令用，在執行緒跑）。"""
+    if not os.path.isdir(WARN_ARCHIVE_DIR):
+        return []
+    out = []
+    for name in sorted(os.listdir(WARN_ARCHIVE_DIR)):
+        with gzip.open(os.path.join(WARN_ARCHIVE_DIR, name), "rt", encoding="utf-8") as f:
+            for line in f:
+                rec = json.loads(line)
+                if rec.pop("uid") == uid:
+                    out.append(rec)
+    return out
+
+
+async def archive_old_warnings() -> int:
+    cutoff = int(time.time() - WARN_HOT_DAYS * 86400)
+    old = [e for index in list(WARN_INDEX.values()) for e in index.pop_before(cutoff)]
+    if not old:
+        return 0
+    try:
+        await asyncio.to_thread(_write_warn_segments, old)
+    except Exception:
+        for uid, rec in old:   # 寫不進去就放回去，下次再試
+            WARN_INDEX[key_slot(uid)].add(uid, rec)
+        raise
+    # 寫檔期間紀錄可能被重置或到期移除：依物件本身移除，人已經不在就跳過
+    archived: Dict[str, set] = {}
+    for uid, rec in old:
+        archived.setdefault(uid, set()).add(id(rec))
+    changed = []
+    for uid, ids in archived.items():
+        recs = WARNINGS.get(uid)
+        if recs is None:
+            continue
+        recs[:] = [r for r in recs if id(r) not in ids]
+        if not recs:
+            del WARNINGS[uid]
+        changed.append(uid)
+    if changed:
+        mark_dirty('warnings', *changed)
+    print(f"🗄️ 已封存 {len(old)} 筆舊警告")
+    return len(old)
+
+
+@tasks.loop(hours=6)
+async def archive_warnings():
+    await archive_old_warnings()
+
+
+# =========================
+# State loading
+# =========================
+STATE_LOADED = False
+# 各階段耗時（秒），on_ready 時印出
+STARTUP: Dict[str, float | str] = {}
+
+
+def load_state():
+    """讀入所有 store（JSON 各檔並行讀）、重播 journal、建排行索引。可在背景執行緒跑。"""
+    global STATE_LOADED
+    start = time.perf_counter()
+    # 快取模式下 users 不整份讀進來，只在建索引時逐筆掃過
+    names = [n for n in JSON_FILES if not (n == "users" and USERS.lazy)]
+    if BACKEND.row_level:
+        data = {name: BACKEND.load(name) for name in names}   # 同一個 SQLite 連線，依序讀
+    else:
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            data = dict(zip(names, pool.map(BACKEND.load, names)))
+    if not USERS.lazy:
+        USERS.update(data["users"])
+    WARNINGS.update(load_warnings(data["warnings"]))
+    FEATURE_PERMS.update(data["feature_perms"])
+    DAILY.update(load_daily(data["daily"]))
+    DM_SESSIONS.update({int(k): v for k, v in data["dm_sessions"].items()})
+    FEATURE_USERS.update(int(k) for k, v in FEATURE_PERMS.items() if v)
+    FEATURE_ROLES.update(int(k) for k, v in data["feature_roles"].items() if v)
+    GUILD_CONFIGS.update({int(k): v for k, v in data["guilds"].items()})
+    BROADCASTS.update(data["broadcasts"])
+    SCHEDULE.update(data["schedule"])
+    SCHEDULER.rebuild()
+    register_guild(GUILD_ID)
+    if ECONOMY_JOURNAL:
+        if JOURNAL.replay(USERS):
+            JOURNAL.compact_sync()
+        else:
+            JOURNAL.open()
+    for slot, raw in data["economy_stats"].items():
+        ECON_STATS[int(slot)].restore(raw)
+    for uid, u in USERS.records():
+        index_user(uid, u)
+        ECON_STATS[key_slot(uid)].add_user(u)
+    index_warnings()
+    STATE_LOADED = True
+    STARTUP["load"] = time.perf_counter() - start
+
+
+LOAD_TASK: asyncio.Task | None = None
+
 # =========================
 # Bot setup
 # =========================
@@ -88,35 +1455,247 @@ intents.message_content = True
 intents.members = True
 intents.guilds = True
 
-bot = commands.Bot(command_prefix="/", intents=intents)
+# 低記憶體模式：不快取成員與訊息、啟動時不 chunk；權限看互動附帶的成員身分組，
+# 顯示名稱要用時才向 gateway 查（TTL 快取）。大伺服器跑在小機器上用。
+LOW_MEMORY = os.environ.get("LOW_MEMORY", "0") == "1"
+MAX_MESSAGES = int(os.environ.get("MAX_MESSAGES", 0 if LOW_MEMORY else 1000))   # 0 = 不快取訊息
+
+bot = commands.AutoShardedBot(
+    command_prefix="/", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+    max_messages=MAX_MESSAGES or None,
+    member_cache_flags=discord.MemberCacheFlags.none() if LOW_MEMORY else discord.MemberCacheFlags.from_intents(intents),
+    chunk_guilds_at_startup=not LOW_MEMORY,
+)
 
 # Presence updater
 @tasks.loop(minutes=5)
 async def update_presence():
-    guild = bot.get_guild(GUILD_ID)
-    served = guild.member_count if guild else 0
+    served = sum(g.member_count or 0 for g in bot.guilds)
     await bot.change_presence(status=discord.Status.idle,
                               activity=discord.Game(f"HFG 機器人 服務了{served}人"))
 
+# ----- Slash 指令同步：只有指令簽章改變才呼叫（有速率限制的）sync -----
+SYNC_STATE_FILE = os.path.join(DATA_DIR, "command_sync.json")
+FORCE_SYNC = os.environ.get("FORCE_SYNC", "0") == "1"
+
+
+def command_tree_hash(guild: discord.abc.Snowflake) -> str:
+    payload = sorted((c.to_dict(bot.tree) for c in bot.tree.get_commands(guild=guild)), key=lambda d: d['name'])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def register_guild_commands(guild_id: int):
+    """指令都定義在主伺服器；其他伺服器複製一份同樣的指令。"""
+    if guild_id == GUILD_ID:
+        return
+    target = discord.Object(id=guild_id)
+    for cmd in bot.tree.get_commands(guild=discord.Object(id=GUILD_ID)):
+        bot.tree.add_command(cmd, guild=target, override=True)
+
+
+async def sync_commands_if_changed(guild_ids: List[int] | None = None):
+    """guild_ids 為 None 時同步目前所在的全部伺服器（on_ready 時呼叫）。"""
+    start = time.perf_counter()
+    state = load_json(SYNC_STATE_FILE, {})
+    synced_any = failed = False
+    for gid in guild_ids or [g.id for g in bot.guilds]:
+        register_guild_commands(gid)
+        guild = discord.Object(id=gid)
+        digest = command_tree_hash(guild)
+        if not FORCE_SYNC and state.get(str(gid)) == digest:
+            continue
+        try:
+            synced = await bot.tree.sync(guild=guild)
+            print(f"✅ 已同步 {len(synced)} 個 Slash 指令 到 guild {gid}")
+            state[str(gid)] = digest
+            synced_any = True
+        except Exception as e:
+            print(f"❌ 同步失敗（guild {gid}）:", e)
+            failed = True
+    if synced_any:
+        save_json(SYNC_STATE_FILE, state)
+    if guild_ids is None and "sync" not in STARTUP:
+        STARTUP["sync"] = "失敗" if failed else time.perf_counter() - start if synced_any else "略過（指令未變更）"
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def memory_report() -> str:
+    members = sum(g.member_count or 0 for g in bot.guilds)
+    cached = sum(len(g.members) for g in bot.guilds)
+    rss = rss_bytes()
+    per = f"（每位成員 {rss / members:.0f} B）" if members else ""
+    ranked = sum(len(idx) for idx in MONEY_INDEX.values())
+    return (f"RSS {rss / 1e6:.1f} MB{per}｜成員 {members}，快取 {cached}"
+            f"｜使用者紀錄 {USERS.resident()}（排行索引 {ranked} 筆）"
+            f"｜訊息快取 {len(bot.cached_messages)}｜{'低記憶體模式' if LOW_MEMORY else '一般模式'}")
+
+
+def startup_report() -> str:
+    def fmt(v):
+        return f"{v:.2f}s" if isinstance(v, float) else str(v)
+    labels = [("import", "import"), ("load", "載入資料"), ("login", "登入"), ("connect", "連線到 ready"), ("sync", "指令同步")]
+    return "｜".join(f"{name} {fmt(STARTUP[key])}" for key, name in labels if key in STARTUP)
+
+
 @bot.event
 async def on_ready():
     await bot.change_presence(status=discord.Status.idle, activity=discord.Game("HFG 機器人 服務了0人"))
-    try:
-        synced = await bot.tree.sync(guild=discord.Object(id=GUILD_ID))
-        print(f"✅ 已同步 {len(synced)} 個 Slash 指令 到 guild {GUILD_ID}")
-    except Exception as e:
-        print("❌ 同步失敗:", e)
-    update_presence.start()
-    print("🟢 Bot ready:", bot.user)
+    for guild in bot.guilds:
+        register_guild(guild.id)
+        rebuild_permission_cache(guild)
+    # 離線期間被移出的伺服器（本行程負責的 shard 才算）
+    present = {g.id for g in bot.guilds}
+    for gid in local_guilds():
+        if gid not in present:
+            forget_guild(gid)
+    # on_ready 在斷線重連後也會觸發，以下只做一次
+    if not update_presence.is_running():
+        update_presence.start()
+    # 已在的伺服器（含離線時加入的）指令沒同步過或有變更就同步；重連時也跑，雜湊沒變就略過
+    if "connect" not in STARTUP and "login_done" in STARTUP:
+        STARTUP["connect"] = time.perf_counter() - STARTUP["login_done"]
+        await sync_commands_if_changed()
+        print("⏱️ 啟動耗時：" + startup_report())
+        print("🧠 記憶體：" + memory_report())
+    else:
+        spawn(sync_commands_if_changed())
+    print("🟢 Bot ready:", bot.user, f"（{len(bot.guilds)} 個伺服器，shards {sorted(bot.shards)}）")
+
+
+@bot.event
+async def on_guild_join(guild: discord.Guild):
+    register_guild(guild.id)
+    rebuild_permission_cache(guild)
+    spawn(sync_commands_if_changed([guild.id]))
+    print(f"➕ 加入伺服器 {guild.name}（{guild.id}），slot {guild_slot(guild.id)}")
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    forget_guild(guild.id)
+    print(f"➖ 離開伺服器 {guild.name}（{guild.id}）")
+
+@bot.event
+async def setup_hook():
+    global LOOP_THREAD_ID
+    # login() 完成 HTTP 登入後才呼叫這裡；資料在登入同時已經開始讀
+    if "login_start" in STARTUP:
+        STARTUP["login"] = time.perf_counter() - STARTUP["login_start"]
+    if LOAD_TASK is not None:
+        await LOAD_TASK
+    elif not STATE_LOADED:
+        await asyncio.to_thread(load_state)
+    STARTUP["login_done"] = time.perf_counter()
+    LOOP_THREAD_ID = threading.get_ident()
+    spawn(monitor_loop_lag())
+    LoopWatchdog(LOOP_THREAD_ID, SLOW_HANDLER_THRESHOLD).start()
+    restore_dm_views()
+    BROADCASTER.resume()
+    spawn(SCHEDULER.run())
+    flush_dirty.start()
+    xp_batch.start()
+    sweep_cooldowns.start()
+    if ECONOMY_JOURNAL:
+        compact_journal.start()
+    archive_warnings.start()
 
 # =========================
 # Permissions / decorators
 # =========================
 
+def is_guild_admin(member: discord.Member) -> bool:
+    """伺服器設定的管理身分組；還沒設定的伺服器以 Discord 的「管理員」權限代替。"""
+    role_id = guild_conf(member.guild.id)["admin_role"]
+    if not role_id:
+        return member.guild_permissions.administrator
+    return any(r.id == role_id for r in member.roles)
+
+
 def is_admin_member(member: discord.Member) -> bool:
     if OWNER_ID and member.id == OWNER_ID:
         return True
-    return any(r.id == ADMIN_ROLE_ID for r in member.roles)
+    guild = getattr(member, 'guild', None)
+    if guild is None:
+        return False
+    if guild.id in PERM_CACHE_READY:
+        return member.id in ADMIN_MEMBERS.get(guild.id, ())
+    return is_guild_admin(member)
+
+
+def has_feature_permission(member: discord.abc.User) -> bool:
+    guild_id = getattr(getattr(member, 'guild', None), 'id', None)
+    if int(member_key(guild_id, member.id)) in FEATURE_USERS:
+        return True
+    if LOW_MEMORY:   # 沒有成員快取可建名單，直接看這個成員身上的身分組
+        return any(r.id in FEATURE_ROLES for r in getattr(member, 'roles', ()))
+    return member.id in FEATURE_ROLE_MEMBERS.get(guild_id, ())
+
+
+def rebuild_permission_cache(guild: discord.Guild | None):
+    """從成員快取重建該伺服器的管理員與身分組開通名單（on_ready / 身分組變動時）。
+    低記憶體模式沒有成員快取，不建名單（is_admin_member 直接看互動成員的身分組）。"""
+    if guild is None or LOW_MEMORY:
+        return
+    role_id = guild_conf(guild.id)["admin_role"]
+    admin_role = guild.get_role(role_id) if role_id else None
+    if admin_role:
+        ADMIN_MEMBERS[guild.id] = {m.id for m in admin_role.members}
+    else:
+        ADMIN_MEMBERS[guild.id] = {m.id for m in guild.members if is_guild_admin(m)}
+    members = FEATURE_ROLE_MEMBERS[guild.id] = set()
+    for rid in FEATURE_ROLES:
+        role = guild.get_role(rid)
+        if role:
+            members.update(m.id for m in role.members)
+    PERM_CACHE_READY.add(guild.id)
+
+
+def refresh_member_permissions(member: discord.Member):
+    """單一成員的身分組變了：只更新這個人。"""
+    gid = member.guild.id
+    if is_guild_admin(member):
+        ADMIN_MEMBERS.setdefault(gid, set()).add(member.id)
+    else:
+        ADMIN_MEMBERS.get(gid, set()).discard(member.id)
+    if any(r.id in FEATURE_ROLES for r in member.roles):
+        FEATURE_ROLE_MEMBERS.setdefault(gid, set()).add(member.id)
+    else:
+        FEATURE_ROLE_MEMBERS.get(gid, set()).discard(member.id)
+
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if before.roles != after.roles:
+        refresh_member_permissions(after)
+
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    ADMIN_MEMBERS.get(member.guild.id, set()).discard(member.id)
+    FEATURE_ROLE_MEMBERS.get(member.guild.id, set()).discard(member.id)
+
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    # 沒設定管理身分組的伺服器以「管理員」權限判斷，權限被改要重算
+    if before.permissions.administrator != after.permissions.administrator and not guild_conf(after.guild.id)["admin_role"]:
+        rebuild_permission_cache(after.guild)
+
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    was_feature = role.id in FEATURE_ROLES
+    if was_feature:
+        FEATURE_ROLES.discard(role.id)
+        mark_dirty('feature_roles', str(role.id))
+    if was_feature or role.id == guild_conf(role.guild.id)["admin_role"]:
+        rebuild_permission_cache(role.guild)
 
 
 def require_admin():
@@ -130,9 +1709,7 @@ def require_admin():
 
 def require_feature_permission():
     async def pred(inter: discord.Interaction):
-        if is_admin_member(inter.user):
-            return True
-        if FEATURE_PERMS.get(str(inter.user.id), False):
+        if has_feature_permission(inter.user) or is_admin_member(inter.user):
             return True
         await inter.response.send_message('🚫 你沒有權限，請聯絡管理員開通。', ephemeral=True)
         return False
@@ -144,14 +1721,394 @@ def require_feature_permission():
 
 def ensure_user(uid: str):
     if uid not in USERS:
-        USERS[uid] = {"money": 0, "xp": 0, "level": 1, "tickets": 0, "items": {}}
+        ECON_STATS[key_slot(uid)].add_user(USERS.create(uid))
+        index_user(uid)
+
+
+def level_for_xp(total: int) -> int:
+    """累積 XP 對應的等級：最大的 L 使 50*L*(L-1) <= total。"""
+    return (math.isqrt(2 * total + 25) // 5 + 1) // 2
+
+
+def add_xp(u: dict, amount: int) -> int:
+    """加 XP 並處理升級（公式直接算，不逐級迴圈），回傳升了幾級。"""
+    total = total_xp(u) + amount
+    old = u['level']
+    u['level'] = max(old, level_for_xp(total))
+    u['xp'] = total - 50 * u['level'] * (u['level'] - 1)
+    return u['level'] - old
+
+
+def _econ_mutate(uid: str, reason: str, money: int = 0, xp: int = 0, tickets: int = 0,
+                 item: str | None = None, qty: int = 0) -> int:
+    ensure_user(uid)
+    USERS.touch(uid)
+    u = USERS[uid]
+    old_level = u['level']
+    u['money'] += money
+    u['tickets'] += tickets
+    gained = add_xp(u, xp) if xp else 0
+    if item:
+        u['items'][item] = u['items'].get(item, 0) + qty
+        if u['items'][item] <= 0:
+            del u['items'][item]
+    if money or xp:
+        index_user(uid)
+    ECON_STATS[key_slot(uid)].apply(reason, money, old_level, u['level'], item, qty)
+    return gained
+
+
+def _econ_event(uid: str, reason: str, money: int = 0, xp: int = 0, tickets: int = 0,
+                item: str | None = None, qty: int = 0, ref: str | None = None) -> dict:
+    u = USERS[uid]
+    ev = {"ts": int(time.time()), "uid": uid, "r": reason}
+    if money:
+        ev["delta_money"] = money
+    if xp:
+        ev["delta_xp"] = xp
+    if tickets:
+        ev["delta_tickets"] = tickets
+    if item:
+        ev["item"] = [item, qty, u['items'].get(item, 0)]
+    if ref:
+        ev["ref"] = ref
+    ev["bal"] = [u['money'], u['xp'], u['level'], u['tickets']]
+    return ev
+
+
+def econ_apply(uid: str, reason: str, money: int = 0, xp: int = 0, tickets: int = 0,
+               item: str | None = None, qty: int = 0, ref: str | None = None) -> int:
+    """套用一筆經濟異動並記錄（journal 或 write-behind），回傳升級數。"""
+    gained = _econ_mutate(uid, reason, money, xp, tickets, item, qty)
+    if ECONOMY_JOURNAL:
+        JOURNAL.append(_econ_event(uid, reason, money, xp, tickets, item, qty, ref))
+    else:
+        mark_dirty('users', uid)
+    return gained
+
+# ----- 多帳戶交易 -----
+# 用法：
+#     async with transaction(a, b, reason='pay') as tx:
+#         tx.debit(a, 100, ref=b)
+#         tx.credit(b, 100, ref=a)
+# 帳戶鎖依 uid 排序取得（不會互鎖）；區塊內可以 await，其他交易碰不到這些帳戶。
+# 離開區塊時一次驗證、套用、寫入；區塊內丟例外則什麼都不改。
+
+class InsufficientFunds(Exception):
+    pass
+
+
+# 限時道具：入帳後幾秒自動收回（購買、空投等任何入帳都在 commit 排程；每筆入帳各自計時）
+TIMED_ITEMS = {"VIP卡": int(os.environ.get("VIP_DAYS", 30)) * 86400}
+
+
+ACCOUNT_LOCKS: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def account_lock(uid: str) -> asyncio.Lock:
+    lock = ACCOUNT_LOCKS.get(uid)
+    if lock is None:
+        lock = ACCOUNT_LOCKS[uid] = asyncio.Lock()
+    return lock
+
+
+class EconomyTx:
+    def __init__(self, uids: set, reason: str):
+        self.uids = uids
+        self.reason = reason
+        # uid -> [money, tickets, {item: qty}, ref]
+        self.ops: Dict[str, list] = {}
+        self.expires: Dict[tuple, int] = {}   # (uid, item) -> 限時道具到期時間（commit 後才有）
+
+    def _op(self, uid: str) -> list:
+        if uid not in self.uids:
+            raise ValueError(f"帳戶 {uid} 不在這筆交易的鎖定範圍內")
+        return self.ops.setdefault(uid, [0, 0, {}, None])
+
+    def balance(self, uid: str) -> int:
+        """含本交易尚未套用的變動後的餘額。"""
+        ensure_user(uid)
+        return USERS[uid]['money'] + self.ops.get(uid, [0])[0]
+
+    def debit(self, uid: str, amount: int, ref: str | None = None):
+        if amount < 0:
+            raise ValueError("amount 不可為負")
+        if self.balance(uid) < amount:
+            raise InsufficientFunds(uid)
+        op = self._op(uid)
+        op[0] -= amount
+        op[3] = ref or op[3]
+
+    def credit(self, uid: str, amount: int, ref: str | None = None):
+        if amount < 0:
+            raise ValueError("amount 不可為負")
+        op = self._op(uid)
+        op[0] += amount
+        op[3] = ref or op[3]
+
+    def add_tickets(self, uid: str, n: int):
+        self._op(uid)[1] += n
+
+    def add_item(self, uid: str, item: str, qty: int = 1):
+        items = self._op(uid)[2]
+        items[item] = items.get(item, 0) + qty
+        ensure_user(uid)
+        if USERS[uid].get('items', {}).get(item, 0) + items[item] < 0:
+            raise ValueError(f"{item} 數量不足")
+
+    def commit(self):
+        events = []
+        for uid, (money, tickets, items, ref) in self.ops.items():
+            first = True
+            for item, qty in (items.items() or [(None, 0)]):
+                if not first:
+                    money = tickets = 0
+                if not (money or tickets or qty):
+                    continue
+                _econ_mutate(uid, self.reason, money=money, tickets=tickets, item=item, qty=qty)
+                if qty > 0 and item in TIMED_ITEMS:
+                    at = self.expires[uid, item] = int(time.time()) + TIMED_ITEMS[item]
+                    SCHEDULER.add("item_expire", at, key_slot(uid), uid=uid, item=item, qty=qty)
+                events.append(_econ_event(uid, self.reason, money=money, tickets=tickets, item=item, qty=qty, ref=ref))
+                first = False
+        if not events:
+            return
+        if ECONOMY_JOURNAL:
+            JOURNAL.append(*events)
+        else:
+            mark_dirty('users', *{ev["uid"] for ev in events})
+
+
+@contextlib.asynccontextmanager
+async def transaction(*uids: str, reason: str):
+    ids = sorted(set(uids), key=int)
+    locks = [account_lock(uid) for uid in ids]
+    for lock in locks:
+        await lock.acquire()
+    try:
+        tx = EconomyTx(set(ids), reason)
+        yield tx
+        tx.commit()
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
+# ----- 冷卻（每指令、每使用者） -----
+# 到期時間放 dict（檢查 O(1)），另外用 heap 依到期時間排序；
+# 每次開始新冷卻前順手把已到期的項目彈掉，記憶體只跟「冷卻中」的人數成正比。
+XP_COOLDOWN = float(os.environ.get("XP_COOLDOWN", 0))               # 秒；0 = 每則訊息都給
+COOLDOWN_WINDOWS: Dict[str, float] = {
+    'message': XP_COOLDOWN,
+    'work': float(os.environ.get("WORK_COOLDOWN", 30)),
+    'scratch': float(os.environ.get("SCRATCH_COOLDOWN", 5)),
+    'lottery': float(os.environ.get("LOTTERY_COOLDOWN", 5)),
+}
+COOLDOWN_REJECTED = metric(Counter("bot_cooldown_rejected_total", "Actions rejected because the user is on cooldown"))
+
+
+class Cooldowns:
+    def __init__(self, windows: Dict[str, float]):
+        self.windows = windows
+        self._until: Dict[tuple, float] = {}   # (指令, uid) -> 到期時間（monotonic）
+        self._heap: List[tuple] = []            # (到期時間, (指令, uid))
+
+    def _sweep(self, now: float):
+        heap, until = self._heap, self._until
+        while heap and heap[0][0] <= now:
+            expiry, key = heapq.heappop(heap)
+            if until.get(key) == expiry:
+                del until[key]
+
+    def sweep(self):
+        self._sweep(time.monotonic())
+
+    def hit(self, name: str, uid) -> float:
+        """冷卻中回傳剩餘秒數（不改任何狀態）；否則開始計時並回傳 0。"""
+        window = self.windows.get(name, 0)
+        if window <= 0:
+            return 0.0
+        now = time.monotonic()
+        key = (name, int(uid))
+        expiry = self._until.get(key)
+        if expiry is not None and expiry > now:
+            COOLDOWN_REJECTED.inc(command=name)
+            return expiry - now
+        self._sweep(now)
+        expiry = now + window
+        self._until[key] = expiry
+        heapq.heappush(self._heap, (expiry, key))
+        return 0.0
+
+    def __len__(self):
+        return len(self._until)
+
+
+COOLDOWNS = Cooldowns(COOLDOWN_WINDOWS)
+
+
+async def reject_cooldown(inter: discord.Interaction, name: str) -> bool:
+    """冷卻中就直接回覆並回傳 True；呼叫端在任何異動之前檢查。"""
+    left = COOLDOWNS.hit(name, member_key(inter.guild_id, inter.user.id))
+    if not left:
+        return False
+    await inter.response.send_message(f'⏳ 冷卻中，請 {math.ceil(left)} 秒後再試', ephemeral=True)
+    return True
+
+
+# 每日獎勵只需知道「今天領過沒」：存日號（int），跨日後舊紀錄直接丟掉
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_DAILY_PRUNED_DAY = 0
+
+
+def day_number() -> int:
+    return int(time.time() // 86400)
+
+
+def load_daily(raw: dict) -> Dict[str, int]:
+    """讀入 daily store：舊格式（ISO 日期字串）轉成日號，只保留今天的紀錄。"""
+    global _DAILY_PRUNED_DAY
+    today = day_number()
+    out, changed = {}, False
+    for uid, v in raw.items():
+        if isinstance(v, str):
+            v = date.fromisoformat(v).toordinal() - _EPOCH_ORDINAL
+            changed = True
+        if v >= today:
+            out[uid] = v
+        else:
+            changed = True
+    if changed:
+        PERSIST.mark('daily')
+    _DAILY_PRUNED_DAY = today
+    return out
+
+
+def prune_daily():
+    """跨日時移除昨天以前的領取紀錄（一天掃一次）。"""
+    global _DAILY_PRUNED_DAY
+    today = day_number()
+    if today == _DAILY_PRUNED_DAY:
+        return
+    _DAILY_PRUNED_DAY = today
+    stale = [uid for uid, d in DAILY.items() if d < today]
+    for uid in stale:
+        del DAILY[uid]
+    if stale:
+        mark_dirty('daily', *stale)
+
+
+@tasks.loop(minutes=1)
+async def sweep_cooldowns():
+    COOLDOWNS.sweep()
+    prune_daily()
 
 
-def save_all():
-    save_json(USERS_FILE, USERS)
-    save_json(WARN_FILE, WARNINGS)
-    save_json(PERMS_FILE, FEATURE_PERMS)
-    save_json(DAILY_FILE, DAILY)
+# ----- 訊息 XP 批次累積 -----
+XP_PER_MESSAGE = 5
+XP_BATCH_INTERVAL = float(os.environ.get("XP_BATCH_INTERVAL", 5))   # 秒
+
+# uid -> [xp, money, 最後發言頻道]
+XP_PENDING: Dict[str, list] = {}
+
+
+def queue_message_xp(message: discord.Message):
+    uid = member_key(message.guild.id, message.author.id)
+    if COOLDOWNS.hit('message', uid):
+        return
+    money = random.randint(0, 2)
+    p = XP_PENDING.get(uid)
+    if p is None:
+        XP_PENDING[uid] = [XP_PER_MESSAGE, money, message.channel]
+    else:
+        p[0] += XP_PER_MESSAGE
+        p[1] += money
+        p[2] = message.channel
+
+
+def drain_message_xp() -> List[tuple]:
+    """套用緩衝中的 XP（每人一筆異動），回傳 [(頻道, uid, 新等級)] 供升級公告。"""
+    pending = dict(XP_PENDING)
+    XP_PENDING.clear()
+    levelups = []
+    for uid, (xp, money, channel) in pending.items():
+        if econ_apply(uid, 'message', money=money, xp=xp):
+            levelups.append((channel, uid, USERS[uid]['level']))
+    return levelups
+
+
+@tasks.loop(seconds=XP_BATCH_INTERVAL)
+async def xp_batch():
+    for channel, uid, lv in drain_message_xp():
+        OUTBOX.level_up(channel, uid, lv)
+
+
+# ----- 成員 / 名稱查詢（低記憶體模式下沒有成員快取） -----
+NAME_CACHE_TTL = float(os.environ.get("NAME_CACHE_TTL", 600))   # 秒
+NAME_CACHE_SIZE = 5000
+MEMBER_QUERY_TIMEOUT = 3.0
+# (guild id, user id) -> (顯示名稱, 到期時間)
+NAME_CACHE: collections.OrderedDict = collections.OrderedDict()
+
+
+async def resolve_members(guild: discord.Guild, user_ids: List[int]) -> Dict[int, discord.Member]:
+    """先看快取，其餘用 gateway 一次查最多 100 人（不放進快取）；查不到的略過。"""
+    found, missing = {}, []
+    for uid in user_ids:
+        m = guild.get_member(uid)
+        if m:
+            found[uid] = m
+        else:
+            missing.append(uid)
+    for i in range(0, len(missing), 100):
+        chunk = missing[i:i + 100]
+        try:
+            members = await asyncio.wait_for(
+                guild.query_members(user_ids=chunk, limit=len(chunk), cache=False), MEMBER_QUERY_TIMEOUT)
+        except (asyncio.TimeoutError, discord.ClientException, discord.HTTPException):
+            continue
+        found.update((m.id, m) for m in members)
+    return found
+
+
+async def display_names(guild: discord.Guild, user_ids: List[int]) -> Dict[int, str]:
+    now = time.monotonic()
+    names, missing = {}, []
+    for uid in user_ids:
+        hit = NAME_CACHE.get((guild.id, uid))
+        if hit and hit[1] > now:
+            NAME_CACHE.move_to_end((guild.id, uid))
+            names[uid] = hit[0]
+        else:
+            missing.append(uid)
+    if missing:
+        for uid, m in (await resolve_members(guild, missing)).items():
+            names[uid] = m.display_name
+            NAME_CACHE[(guild.id, uid)] = (m.display_name, now + NAME_CACHE_TTL)
+        while len(NAME_CACHE) > NAME_CACHE_SIZE:
+            NAME_CACHE.popitem(last=False)
+    return names
+
+
+async def get_or_fetch_user(user_id: int) -> discord.User | None:
+    user = bot.get_user(user_id)
+    if user is None:
+        try:
+            user = await bot.fetch_user(user_id)
+        except discord.HTTPException:
+            return None
+    return user
+
+
+BACKGROUND_TASKS: set = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    """建立背景 task 並保留參照（避免被 GC 回收）。"""
+    task = asyncio.get_running_loop().create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
 
 
 def parse_duration(text: str) -> int:
@@ -176,10 +2133,499 @@ async def gen_math_questions(n: int) -> List[dict]:
         qs.append({'q': f"{a} {op} {b} = ?", 'a': ans})
     return qs
 
+# =========================
+# Outbound message queue
+# =========================
+# 所有「順便通知」類的訊息都丟進這裡：每個頻道/使用者一個 worker，依頻道速率送出，
+# 遇到 429/5xx 重試；同一頻道待送的升級公告合併成一則。呼叫端不用等 send。
+OUTBOX_RATE = int(os.environ.get("OUTBOX_RATE", 5))            # 每個頻道每 OUTBOX_PER 秒最多幾則
+OUTBOX_PER = float(os.environ.get("OUTBOX_PER", 5))
+OUTBOX_MAX_PENDING = int(os.environ.get("OUTBOX_MAX_PENDING", 100))
+OUTBOX_RETRIES = 3
+OUTBOX_RESULTS = ("sent", "dropped", "retried", "failed", "coalesced")
+OUTBOX_MESSAGES = metric(Counter("bot_outbox_messages_total", "Outbound messages by result"))
+
+
+class OutboundQueue:
+    def __init__(self):
+        self.queues: Dict[int, asyncio.Queue] = {}
+        self.levelups: Dict[int, Dict[str, int]] = {}
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        return {k: int(OUTBOX_MESSAGES.values.get((("result", k),), 0)) for k in OUTBOX_RESULTS}
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues.values())
+
+    def _queue(self, target) -> asyncio.Queue | None:
+        q = self.queues.get(target.id)
+        if q is None:
+            q = self.queues[target.id] = asyncio.Queue()
+            spawn(self._worker(target.id, q))
+        if q.qsize() >= OUTBOX_MAX_PENDING:
+            OUTBOX_MESSAGES.inc(result="dropped")
+            return None
+        return q
+
+    def post(self, target: discord.abc.Messageable, **kwargs):
+        """送出但不等結果（失敗只計數）。"""
+        q = self._queue(target)
+        if q:
+            q.put_nowait((target, kwargs, None))
+
+    def send(self, target: discord.abc.Messageable, **kwargs) -> asyncio.Future:
+        """送出並回傳 Future（結果為 discord.Message，失敗時為例外）。"""
+        fut = asyncio.get_running_loop().create_future()
+        q = self._queue(target)
+        if q:
+            q.put_nowait((target, kwargs, fut))
+        else:
+            fut.set_exception(asyncio.QueueFull())
+        return fut
+
+    def level_up(self, channel: discord.abc.Messageable, uid: str, level: int):
+        pending = self.levelups.get(channel.id)
+        if pending is not None:
+            pending[uid] = level
+            OUTBOX_MESSAGES.inc(result="coalesced")
+            return
+        q = self._queue(channel)
+        if q:
+            self.levelups[channel.id] = {uid: level}
+            q.put_nowait((channel, None, None))
+
+    async def _deliver(self, target, kwargs: dict):
+        for attempt in range(OUTBOX_RETRIES + 1):
+            try:
+                msg = await target.send(**kwargs)
+                OUTBOX_MESSAGES.inc(result="sent")
+                return msg
+            except (discord.Forbidden, discord.NotFound):
+                OUTBOX_MESSAGES.inc(result="dropped")
+                raise
+            except discord.HTTPException as e:
+                if (e.status == 429 or e.status >= 500) and attempt < OUTBOX_RETRIES:
+                    OUTBOX_MESSAGES.inc(result="retried")
+                    await asyncio.sleep(getattr(e, "retry_after", None) or 2 ** attempt)
+                    continue
+                OUTBOX_MESSAGES.inc(result="failed")
+                raise
+
+    async def _worker(self, key: int, q: asyncio.Queue):
+        sent_at: deque = deque()
+        while True:
+            try:
+                target, kwargs, fut = await asyncio.wait_for(q.get(), timeout=60)
+            except asyncio.TimeoutError:
+                if q.empty():
+                    del self.queues[key]
+                    return
+                continue
+            # 頻道速率：最近 OUTBOX_PER 秒內送滿 OUTBOX_RATE 則就等
+            now = time.monotonic()
+            while sent_at and now - sent_at[0] >= OUTBOX_PER:
+                sent_at.popleft()
+            if len(sent_at) >= OUTBOX_RATE:
+                await asyncio.sleep(OUTBOX_PER - (now - sent_at[0]))
+                sent_at.popleft()
+            sent_at.append(time.monotonic())
+
+            payloads = [kwargs] if kwargs is not None else self._levelup_payloads(key)
+            for payload in payloads:
+                try:
+                    msg = await self._deliver(target, payload)
+                    if fut and not fut.done():
+                        fut.set_result(msg)
+                except Exception as e:
+                    if fut and not fut.done():
+                        fut.set_exception(e)
+
+    def _levelup_payloads(self, key: int) -> List[dict]:
+        lines = [f'🎉 <@{key_user(uid)}> 升級到 {lv} 級！' for uid, lv in self.levelups.pop(key, {}).items()]
+        chunks, cur = [], ''
+        for line in lines:
+            if len(cur) + len(line) + 1 > 2000:
+                chunks.append(cur)
+                cur = ''
+            cur = f'{cur}\n{line}' if cur else line
+        if cur:
+            chunks.append(cur)
+        return [{"content": c} for c in chunks]
+
+
+OUTBOX = OutboundQueue()
+
+# =========================
+# Deferred jobs
+# =========================
+# 會等 HTTP、讀檔或算比較久的指令先 defer（3 秒內一定回應），實際工作丟進這裡：
+# 固定數量的 worker 依序執行、每個工作有逾時，結果用 followup 送出。
+# 工作回傳 str → 內容；dict → followup.send 的參數；None → 不另外回覆（工作自己送了）。
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 8))
+JOB_TIMEOUT = float(os.environ.get("JOB_TIMEOUT", 30))
+JOB_MAX_PENDING = int(os.environ.get("JOB_MAX_PENDING", 500))
+
+JOB_SECONDS = metric(Histogram("bot_job_seconds", "Deferred job run time"))
+JOB_WAIT_SECONDS = metric(Histogram("bot_job_wait_seconds", "Time a deferred job waited in the queue"))
+JOBS_TOTAL = metric(Counter("bot_jobs_total", "Deferred jobs by result"))
+
+
+class JobRunner:
+    def __init__(self, workers: int, timeout: float, max_pending: int):
+        self.workers = workers
+        self.timeout = timeout
+        self.queue: asyncio.Queue = asyncio.Queue(max_pending)
+        self.tasks: List[asyncio.Task] = []
+        self.running = 0
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def _start(self):
+        # 第一次送工作時才開 worker（離線工具、壓力測試不用經過 setup_hook）
+        self.tasks = [t for t in self.tasks if not t.done()]
+        while len(self.tasks) < self.workers:
+            self.tasks.append(spawn(self._worker()))
+
+    async def submit(self, inter: discord.Interaction, name: str, work, ephemeral: bool = False,
+                     timeout: float | None = None) -> bool:
+        """先 defer，再把 work（無參數的 coroutine function）排進佇列；滿了就直接回覆忙碌並回傳 False。"""
+        if self.queue.full():
+            JOBS_TOTAL.inc(job=name, result="rejected")
+            msg = '⏳ 機器人忙碌中，請稍後再試'
+            if inter.response.is_done():
+                await inter.followup.send(msg, ephemeral=True)
+            else:
+                await inter.response.send_message(msg, ephemeral=True)
+            return False
+        if not inter.response.is_done():
+            await inter.response.defer(ephemeral=ephemeral, thinking=True)
+        self._start()
+        self.queue.put_nowait((inter, name, work, ephemeral, timeout or self.timeout, time.perf_counter()))
+        return True
+
+    async def _run(self, inter: discord.Interaction, name: str, work, ephemeral: bool, timeout: float):
+        try:
+            result = await asyncio.wait_for(work(), timeout)
+        except asyncio.TimeoutError:
+            JOBS_TOTAL.inc(job=name, result="timeout")
+            result = '⌛ 處理逾時，請稍後再試'
+        except Exception as e:
+            JOBS_TOTAL.inc(job=name, result="error")
+            print(f"⚠️ 工作 {name} 失敗：{e!r}")
+            result = '❌ 處理時發生錯誤'
+        else:
+            JOBS_TOTAL.inc(job=name, result="ok")
+        if result is None:
+            return
+        kwargs = {"content": result} if isinstance(result, str) else dict(result)
+        kwargs.setdefault("ephemeral", ephemeral)
+        try:
+            await inter.followup.send(**kwargs)
+        except discord.HTTPException as e:
+            print(f"⚠️ 工作 {name} 回覆失敗：{e}")
+
+    async def _worker(self):
+        while True:
+            inter, name, work, ephemeral, timeout, queued = await self.queue.get()
+            start = time.perf_counter()
+            JOB_WAIT_SECONDS.observe(start - queued)
+            self.running += 1
+            try:
+                await self._run(inter, name, work, ephemeral, timeout)
+            finally:
+                self.running -= 1
+                JOB_SECONDS.observe(time.perf_counter() - start, job=name)
+                self.queue.task_done()
+
+    async def drain(self):
+        """等佇列內的工作都做完（關機、壓力測試用）。"""
+        if self.tasks:
+            await self.queue.join()
+
+
+JOBS = JobRunner(JOB_WORKERS, JOB_TIMEOUT, JOB_MAX_PENDING)
+
+# =========================
+# Broadcasts
+# =========================
+# 對多個頻道發公告、或私訊某身分組全部成員。目標清單建立時就固定下來存進 broadcasts store，
+# 依序每 BROADCAST_CHUNK 個一段並行送出（BROADCAST_CONCURRENCY 個同時、全域每秒 BROADCAST_RATE 則）。
+# 每送完一個目標就記進 partial 並立刻寫檔，一段做完才推進 cursor、清空 partial：
+# 重啟後從 cursor 接著送並跳過 partial，最多重送中斷當下正在送的那幾則。
+# 結束時在發起的頻道貼出送達報告（成功 / 拒收 / 失敗）。
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 10))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 5))
+BROADCAST_CHUNK = 50
+BROADCAST_RETRIES = 3
+BROADCAST_KEEP_DONE = 20   # 保留最近幾筆已完成的報告
+
+BROADCAST_SENT = metric(Counter("bot_broadcast_messages_total", "Broadcast deliveries by result"))
+
+
+class Broadcaster:
+    def __init__(self, rate: float, concurrency: int):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.sem = asyncio.Semaphore(concurrency)
+        self.next_slot = 0.0
+        self.running: Dict[str, asyncio.Task] = {}
+
+    def create(self, kind: str, guild_id: int, by: int, report: int, content: dict, targets: List[int]) -> str:
+        bid = f"{int(time.time() * 1000):x}"
+        BROADCASTS[bid] = {
+            "kind": kind, "guild": guild_id, "by": by, "report": report, "content": content,
+            "targets": targets, "total": len(targets), "cursor": 0, "partial": [], "counts": {"sent": 0, "forbidden": 0, "failed": 0},
+            "done": False, "created": int(time.time()),
+        }
+        mark_dirty('broadcasts', bid)
+        self.start(bid)
+        return bid
+
+    def start(self, bid: str):
+        if bid not in self.running:
+            self.running[bid] = spawn(self._run(bid))
+
+    def resume(self):
+        """重啟後接著送還沒完成的廣播。"""
+        for bid, b in BROADCASTS.items():
+            if not b["done"]:
+                self.start(bid)
+
+    def cancel(self, bid: str) -> bool:
+        task = self.running.get(bid)
+        if task is None:
+            return False
+        BROADCASTS[bid]["cancelled"] = True
+        task.cancel()
+        return True
+
+    async def _pace(self):
+        # 全域速率：每則訊息預約下一個時間格
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _target(self, kind: str, tid: int):
+        if kind == "channels":
+            return bot.get_channel(tid) or await bot.fetch_channel(tid)
+        return await get_or_fetch_user(tid)
+
+    async def _deliver(self, kind: str, tid: int, content: dict) -> str:
+        async with self.sem:
+            for attempt in range(BROADCAST_RETRIES + 1):
+                await self._pace()
+                try:
+                    target = await self._target(kind, tid)
+                    if target is None:
+                        return "failed"
+                    await target.send(**content)
+                    return "sent"
+                except discord.Forbidden:
+                    return "forbidden"
+                except discord.NotFound:
+                    return "failed"
+                except discord.HTTPException as e:
+                    if (e.status == 429 or e.status >= 500) and attempt < BROADCAST_RETRIES:
+                        await asyncio.sleep(getattr(e, "retry_after", None) or 2 ** attempt)
+                        continue
+                    return "failed"
+            return "failed"
+
+    async def _send_one(self, bid: str, tid: int, content: dict):
+        b = BROADCASTS[bid]
+        r = await self._deliver(b["kind"], tid, content)
+        b["counts"][r] += 1
+        BROADCAST_SENT.inc(kind=b["kind"], result=r)
+        b["partial"].append(tid)
+        mark_dirty('broadcasts', bid)
+        await PERSIST.flush_async()   # checkpoint：這個目標之後重啟不會再送
+
+    async def _run(self, bid: str):
+        b = BROADCASTS[bid]
+        content = dict(b["content"])
+        if "embed" in content:
+            content["embed"] = discord.Embed.from_dict(content["embed"])
+        try:
+            await bot.wait_until_ready()
+            targets = b["targets"]
+            while b["cursor"] < len(targets):
+                chunk = targets[b["cursor"]:b["cursor"] + BROADCAST_CHUNK]
+                sent = set(b.setdefault("partial", []))   # 中斷前這一段已經送過的
+                await asyncio.gather(*(self._send_one(bid, tid, content) for tid in chunk if tid not in sent))
+                b["cursor"] += len(chunk)
+                b["partial"] = []
+                mark_dirty('broadcasts', bid)
+            b["done"] = True
+        except asyncio.CancelledError:
+            if not b.get("cancelled"):
+                raise   # 關機：保持未完成，重啟後從 cursor 繼續
+            b["done"] = True
+        finally:
+            self.running.pop(bid, None)
+            if b["done"]:
+                b["targets"] = []   # 完成後只留報告
+                mark_dirty('broadcasts', bid, *self._prune())
+                ch = bot.get_channel(b["report"])
+                if ch:
+                    OUTBOX.post(ch, content=self.report(bid))
+
+    def _prune(self) -> List[str]:
+        done = sorted((bid for bid, b in BROADCASTS.items() if b["done"]), key=lambda k: BROADCASTS[k]["created"])
+        old = done[:-BROADCAST_KEEP_DONE]
+        for bid in old:
+            del BROADCASTS[bid]
+        return old
+
+    def report(self, bid: str) -> str:
+        b = BROADCASTS[bid]
+        c = b["counts"]
+        what = '頻道公告' if b["kind"] == "channels" else '身分組私訊'
+        if b.get("cancelled"):
+            state = '⛔ 已取消'
+        elif b["done"]:
+            state = '📣 已完成'
+        else:
+            state = '⏳ 進行中'
+        return (f"{state} {what} `{bid}`（<@{b['by']}>）：{b['cursor'] + len(b.get('partial', []))}/{b['total']}"
+                f"｜成功 {c['sent']}｜拒收 {c['forbidden']}｜失敗 {c['failed']}")
+
+
+BROADCASTER = Broadcaster(BROADCAST_RATE, BROADCAST_CONCURRENCY)
+
+# =========================
+# Scheduler
+# =========================
+# 自己的定時動作（警告到期、限時道具、排程公告）存在 schedule store，重啟後重建。
+# 記憶體裡是 (到期時間, id) 的 min-heap：新增 O(log n)；取消只刪 SCHEDULE 裡那筆，
+# heap 裡的舊項目輪到時才丟（過期項目超過一半就整理一次）。
+# 背景 task 只睡到最早的到期時間，新增更早的動作時被叫醒，不用輪詢。
+SCHEDULED_RUNS = metric(Counter("bot_scheduled_runs_total", "Scheduled actions run, by kind and result"))
+
+# kind -> async handler(**args)
+SCHEDULED_ACTIONS: Dict[str, object] = {}
+
+
+def scheduled_action(kind: str):
+    def deco(fn):
+        SCHEDULED_ACTIONS[kind] = fn
+        return fn
+    return deco
+
+
+def local_slots() -> set | None:
+    """本行程負責的 slot（沒分 shard group 時回傳 None = 全部）。"""
+    if SHARD_IDS and SHARD_COUNT:
+        return {guild_slot(gid) for gid in local_guilds()}
+    return None
+
+
+class Scheduler:
+    def __init__(self):
+        self.heap: List[tuple] = []
+        self.wake = asyncio.Event()
+        self.seq = itertools.count()
+
+    def rebuild(self):
+        local = local_slots()
+        self.heap = [(a["at"], sid) for sid, a in SCHEDULE.items() if local is None or a["slot"] in local]
+        heapq.heapify(self.heap)
+
+    def add(self, kind: str, at: float, slot: int, **args) -> str:
+        # 序號不取餘數：空投一次可能在同一毫秒排上千筆
+        sid = f"{int(time.time() * 1000):x}{next(self.seq):03d}"
+        SCHEDULE[sid] = {"at": int(at), "kind": kind, "slot": slot, "args": args}
+        mark_dirty('schedule', sid)
+        if not self.heap or at < self.heap[0][0]:
+            self.wake.set()
+        heapq.heappush(self.heap, (int(at), sid))
+        return sid
+
+    def cancel(self, sid: str) -> bool:
+        if SCHEDULE.pop(sid, None) is None:
+            return False
+        mark_dirty('schedule', sid)
+        if len(self.heap) > 2 * len(SCHEDULE) + 64:
+            self.heap = [e for e in self.heap if e[1] in SCHEDULE]
+            heapq.heapify(self.heap)
+        return True
+
+    def pending(self, slot: int, n: int) -> List[tuple]:
+        return heapq.nsmallest(n, ((a["at"], sid) for sid, a in SCHEDULE.items() if a["slot"] == slot))
+
+    def _next(self) -> tuple | None:
+        # 丟掉已取消的舊項目
+        while self.heap and self.heap[0][1] not in SCHEDULE:
+            heapq.heappop(self.heap)
+        return self.heap[0] if self.heap else None
+
+    async def run(self):
+        while True:
+            self.wake.clear()
+            head = self._next()
+            delay = None if head is None else head[0] - time.time()
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.heap)
+            action = SCHEDULE.pop(head[1])
+            mark_dirty('schedule', head[1])
+            await self._fire(action)
+
+    async def _fire(self, action: dict):
+        kind = action["kind"]
+        handler = SCHEDULED_ACTIONS.get(kind)
+        try:
+            if handler is None:
+                raise LookupError(f"未知的排程動作 {kind}")
+            await handler(**action["args"])
+            SCHEDULED_RUNS.inc(kind=kind, result="ok")
+        except Exception as e:
+            SCHEDULED_RUNS.inc(kind=kind, result="error")
+            print(f"⚠️ 排程動作 {kind} 失敗：{e!r}")
+
+
+SCHEDULER = Scheduler()
+
+
+@scheduled_action("warn_expire")
+async def _expire_warning(uid: str, ts: int, mod: int):
+    expire_warning(uid, ts, mod)
+
+
+@scheduled_action("item_expire")
+async def _expire_item(uid: str, item: str, qty: int):
+    async with transaction(uid, reason='expire') as tx:
+        held = USERS[uid]['items'].get(item, 0) if uid in USERS else 0
+        if held:
+            tx.add_item(uid, item, -min(qty, held))
+
+
+@scheduled_action("announce")
+async def _scheduled_announce(channel: int, embed: dict):
+    ch = bot.get_channel(channel)
+    if ch:
+        OUTBOX.post(ch, embed=discord.Embed.from_dict(embed))
+
 # =========================
 # Slash commands
 # =========================
 
+class TimedView(discord.ui.View):
+    """按鈕 callback 都包上 timed_handler。"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for item in self.children:
+            func = getattr(item.callback, 'callback', item.callback)
+            item.callback = timed_handler(f'view:{type(self).__name__}.{func.__name__}')(item.callback)
+
+
 @bot.tree.command(name='help', description='顯示可用指令列表', guild=discord.Object(id=GUILD_ID))
 async def help_cmd(inter: discord.Interaction):
     cmds = bot.tree.get_commands(guild=discord.Object(id=GUILD_ID))
@@ -191,7 +2637,7 @@ async def help_cmd(inter: discord.Interaction):
 @require_feature_permission()
 async def balance(inter: discord.Interaction, member: discord.Member | None = None):
     m = member or inter.user
-    uid = str(m.id)
+    uid = member_key(inter.guild_id, m.id)
     ensure_user(uid)
     await inter.response.send_message(f'💰 {m.display_name}：{USERS[uid]["money"]} 金幣 | 等級：{USERS[uid]["level"]} | XP：{USERS[uid]["xp"]}')
 
@@ -199,9 +2645,9 @@ async def balance(inter: discord.Interaction, member: discord.Member | None = No
 @require_feature_permission()
 async def profile(inter: discord.Interaction, member: discord.Member | None = None):
     m = member or inter.user
-    uid = str(m.id)
+    uid = member_key(inter.guild_id, m.id)
     ensure_user(uid)
-    items = ', '.join([f"{k}x{v}" for k, v in USERS[uid]['items'].items()]) or '無'
+    items = ', '.join([f"{k}x{v}" for k, v in USERS[uid].get('items', {}).items()]) or '無'
     await inter.response.send_message(f"""👤 {m.display_name}
     💰 金幣: {USERS[uid]['money']}
     ⭐ 等級: {USERS[uid]['level']} (XP {USERS[uid]['xp']})
@@ -209,28 +2655,54 @@ async def profile(inter: discord.Interaction, member: discord.Member | None = No
     🎁 道具: {items}"""
         )
 
-@bot.tree.command(name='leaderboard', description='金錢排行榜（前 10）', guild=discord.Object(id=GUILD_ID))
+BOARDS = {'money': MONEY_INDEX, 'xp': XP_INDEX, 'level': XP_INDEX}
+
+
+def board_value(board: str, uid: str) -> str:
+    u = USERS[uid]
+    if board == 'money':
+        return f"{u['money']} 金幣"
+    if board == 'xp':
+        return f"{total_xp(u)} XP"
+    return f"等級 {u['level']}"
+
+
+@bot.tree.command(name='leaderboard', description='排行榜（金錢/XP/等級，前 10）', guild=discord.Object(id=GUILD_ID))
 @require_feature_permission()
-async def leaderboard(inter: discord.Interaction):
-    data = sorted(USERS.items(), key=lambda kv: kv[1].get('money', 0), reverse=True)[:10]
-    lines = []
-    for i,(uid,ud) in enumerate(data, start=1):
-        member = inter.guild.get_member(int(uid))
-        name = member.display_name if member else uid
-        lines.append(f"#{i} {name} — {ud.get('money',0)} 金幣")
-    await inter.response.send_message(''.join(lines) or '目前沒有資料')
+async def leaderboard(inter: discord.Interaction, board: Literal['money', 'xp', 'level'] = 'money'):
+    top = BOARDS[board][guild_slot(inter.guild_id)].top(10)
+
+    async def work():
+        # 低記憶體模式下名稱要向 gateway 查，放在 defer 之後
+        names = await display_names(inter.guild, [key_user(uid) for uid, _ in top])
+        lines = []
+        for i, (uid, _) in enumerate(top, start=1):
+            name = names.get(key_user(uid), key_user(uid))
+            lines.append(f"#{i} {name} — {board_value(board, str(uid))}")
+        return ''.join(lines) or '目前沒有資料'
+    await JOBS.submit(inter, 'leaderboard', work)
+
+@bot.tree.command(name='rank', description='查看排行名次（金錢/XP/等級）', guild=discord.Object(id=GUILD_ID))
+@require_feature_permission()
+async def rank(inter: discord.Interaction, member: discord.Member | None = None, board: Literal['money', 'xp', 'level'] = 'money'):
+    m = member or inter.user
+    uid = member_key(inter.guild_id, m.id)
+    ensure_user(uid)
+    index = BOARDS[board][guild_slot(inter.guild_id)]
+    await inter.response.send_message(f"🏅 {m.display_name} 排名 #{index.rank(int(uid))} / {len(index)}（{board_value(board, uid)}）")
 
 # --- work（掃地/寫作業出題）---
 @bot.tree.command(name='work', description='工作賺錢（掃地/寫作業）', guild=discord.Object(id=GUILD_ID))
 @require_feature_permission()
 async def work(inter: discord.Interaction, questions: int = 0):
-    uid = str(inter.user.id)
+    if await reject_cooldown(inter, 'work'):
+        return
+    uid = member_key(inter.guild_id, inter.user.id)
     ensure_user(uid)
     job = random.choice(['掃地','寫作業'])
     earn = random.randint(20, 150)
     xp = random.randint(5, 30)
-    USERS[uid]['money'] += earn
-    USERS[uid]['xp'] += xp
+    gained = econ_apply(uid, 'work', money=earn, xp=xp)
 
     detail = ''
     if job == '寫作業':
@@ -241,33 +2713,28 @@ async def work(inter: discord.Interaction, questions: int = 0):
         repeat = random.choice([True, False])
         detail = "掃地完成！" + ("（又弄髒了再清一次✔）" if repeat else '')
 
-    levelup = ''
-    while USERS[uid]['xp'] >= USERS[uid]['level'] * 100:
-        USERS[uid]['xp'] -= USERS[uid]['level'] * 100
-        USERS[uid]['level'] += 1
-        levelup += f"🎉 升級到 {USERS[uid]['level']} 級！"
-
-    save_all()
+    lv = USERS[uid]['level']
+    levelup = ''.join(f"🎉 升級到 {n} 級！" for n in range(lv - gained + 1, lv + 1))
     await inter.response.send_message(f"✅ {inter.user.display_name}{job}獲得 {earn} 金幣、{xp} XP{levelup}{detail}")
 
 # --- daily ---
 @bot.tree.command(name='daily', description='每日領取獎勵', guild=discord.Object(id=GUILD_ID))
 @require_feature_permission()
 async def daily(inter: discord.Interaction):
-    uid = str(inter.user.id)
-    today = datetime.utcnow().date().isoformat()
+    uid = member_key(inter.guild_id, inter.user.id)
+    today = day_number()
     if DAILY.get(uid) == today:
         await inter.response.send_message('⏳ 今天已領取過每日獎勵', ephemeral=True)
         return
     ensure_user(uid)
     gain = random.randint(80, 200)
-    USERS[uid]['money'] += gain
+    econ_apply(uid, 'daily', money=gain)
     DAILY[uid] = today
-    save_all()
+    mark_dirty('daily', uid)
     await inter.response.send_message(f'🎁 已領取每日 {gain} 金幣')
 
 # --- pay (含確認按鈕) ---
-class PayConfirmView(discord.ui.View):
+class PayConfirmView(TimedView):
     def __init__(self, payer: int, target: int, amount: int):
         super().__init__(timeout=60)
         self.payer = payer
@@ -279,16 +2746,15 @@ class PayConfirmView(discord.ui.View):
         if inter.user.id != self.payer:
             await inter.response.send_message('只有付款者可按確認', ephemeral=True)
             return
-        p = str(self.payer)
-        t = str(self.target)
-        ensure_user(p)
-        ensure_user(t)
-        if USERS[p]['money'] < self.amount:
+        p = member_key(inter.guild_id, self.payer)
+        t = member_key(inter.guild_id, self.target)
+        try:
+            async with transaction(p, t, reason='pay') as tx:
+                tx.debit(p, self.amount, ref=t)
+                tx.credit(t, self.amount, ref=p)
+        except InsufficientFunds:
             await inter.response.send_message('餘額不足', ephemeral=True)
             return
-        USERS[p]['money'] -= self.amount
-        USERS[t]['money'] += self.amount
-        save_all()
         await inter.response.edit_message(content=f'✅ 轉帳成功：{self.amount} 金幣 已轉給 <@{self.target}>', view=None)
 
     @discord.ui.button(label='取消', style=discord.ButtonStyle.red)
@@ -301,7 +2767,7 @@ class PayConfirmView(discord.ui.View):
 @bot.tree.command(name='pay', description='轉帳給他人', guild=discord.Object(id=GUILD_ID))
 @require_feature_permission()
 async def pay(inter: discord.Interaction, target: discord.Member, amount: int):
-    payer = str(inter.user.id)
+    payer = member_key(inter.guild_id, inter.user.id)
     ensure_user(payer)
     if amount <= 0:
         await inter.response.send_message('金額需大於 0', ephemeral=True)
@@ -313,89 +2779,183 @@ async def pay(inter: discord.Interaction, target: discord.Member, amount: int):
     await inter.response.send_message(f'請確認是否要轉帳 {amount} 金幣 給 {target.display_name}', view=view, ephemeral=True)
 
 # --- lottery / scratch ---
-class LotteryView(discord.ui.View):
-    def __init__(self, cost=10):
-        super().__init__(timeout=None)
+# 獎項表：(獎金, 權重)。改機率只要改這裡，再用 /prize_sim 看期望值。
+MAX_TICKETS = 100
+
+
+class PrizeTable:
+    def __init__(self, cost: int, prizes: List[tuple]):
         self.cost = cost
+        self.prizes = [p for p, _ in prizes]
+        self.cum_weights = list(itertools.accumulate(w for _, w in prizes))
+        self.total = self.cum_weights[-1]
+
+    def draw(self, count: int = 1, rng: random.Random = random) -> List[int]:
+        """一次抽 count 張（累積權重 + 二分搜尋）。"""
+        return rng.choices(self.prizes, cum_weights=self.cum_weights, k=count)
+
+    def expected(self) -> tuple:
+        """理論上每張的 (期望獎金, 變異數)。"""
+        prev, ev, ev2 = 0, 0.0, 0.0
+        for prize, cw in zip(self.prizes, self.cum_weights):
+            p = (cw - prev) / self.total
+            prev = cw
+            ev += p * prize
+            ev2 += p * prize * prize
+        return ev, ev2 - ev * ev
+
+
+PRIZE_TABLES: Dict[str, PrizeTable] = {
+    'scratch': PrizeTable(20, [(1000, 2), (200, 8), (50, 30), (0, 60)]),
+    'lottery': PrizeTable(10, [(2000, 3), (300, 12), (50, 35), (0, 50)]),
+}
+
+
+async def buy_tickets(inter: discord.Interaction, table: str, count: int) -> List[int] | None:
+    """扣 count 張的費用、一次抽完、一次交易寫入；金幣不足回傳 None。"""
+    uid = member_key(inter.guild_id, inter.user.id)
+    t = PRIZE_TABLES[table]
+    try:
+        async with transaction(uid, reason=table) as tx:
+            tx.debit(uid, t.cost * count)
+            prizes = t.draw(count)
+            tx.credit(uid, sum(prizes))
+    except InsufficientFunds:
+        return None
+    return prizes
+
+
+def ticket_summary(prizes: List[int], cost: int) -> str:
+    won = sum(prizes)
+    hits = sum(1 for p in prizes if p)
+    return (f'共 {len(prizes)} 張，中獎 {hits} 張，獎金 {won} 金幣'
+            f'（最大獎 {max(prizes)}，淨 {won - cost * len(prizes):+d}）')
+
+
+class LotteryView(TimedView):
+    def __init__(self, count: int = 1):
+        super().__init__(timeout=None)
+        self.count = count
 
     @discord.ui.button(label='參加抽獎', style=discord.ButtonStyle.primary)
     async def join(self, inter: discord.Interaction, button: discord.ui.Button):
-        uid = str(inter.user.id)
-        ensure_user(uid)
-        if USERS[uid]['money'] < self.cost:
+        if await reject_cooldown(inter, 'lottery'):
+            return
+        prizes = await buy_tickets(inter, 'lottery', self.count)
+        if prizes is None:
             await inter.response.send_message('金幣不足參加抽獎', ephemeral=True)
             return
-        USERS[uid]['money'] -= self.cost
-        roll = random.random()
-        if roll < 0.03: prize = 2000
-        elif roll < 0.15: prize = 300
-        elif roll < 0.5: prize = 50
-        else: prize = 0
-        USERS[uid]['money'] += prize
-        save_all()
-        msg = f'🎉 恭喜你中獎！獲得 {prize} 金幣' if prize else '未中獎，下次再試！'
+        if self.count > 1:
+            msg = '🎟️ ' + ticket_summary(prizes, PRIZE_TABLES['lottery'].cost)
+        else:
+            msg = f'🎉 恭喜你中獎！獲得 {prizes[0]} 金幣' if prizes[0] else '未中獎，下次再試！'
         await inter.response.send_message(msg, ephemeral=True)
 
 @bot.tree.command(name='lottery', description='參加抽獎', guild=discord.Object(id=GUILD_ID))
 @require_feature_permission()
-async def lottery(inter: discord.Interaction):
-    await inter.response.send_message('按下「參加抽獎」按鈕報名（費用 10 金幣）', view=LotteryView(), ephemeral=True)
+async def lottery(inter: discord.Interaction, count: app_commands.Range[int, 1, MAX_TICKETS] = 1):
+    cost = PRIZE_TABLES['lottery'].cost * count
+    await inter.response.send_message(f'按下「參加抽獎」按鈕報名（{count} 張，費用 {cost} 金幣）',
+                                      view=LotteryView(count), ephemeral=True)
 
 @bot.tree.command(name='scratch', description='刮刮樂抽獎（20 金幣/次）', guild=discord.Object(id=GUILD_ID))
 @require_feature_permission()
-async def scratch(inter: discord.Interaction):
-    uid = str(inter.user.id)
-    ensure_user(uid)
-    cost = 20
-    if USERS[uid]['money'] < cost:
+async def scratch(inter: discord.Interaction, count: app_commands.Range[int, 1, MAX_TICKETS] = 1):
+    if await reject_cooldown(inter, 'scratch'):
+        return
+    prizes = await buy_tickets(inter, 'scratch', count)
+    if prizes is None:
         await inter.response.send_message('金幣不足刮刮樂', ephemeral=True)
         return
-    USERS[uid]['money'] -= cost
-    roll = random.random()
-    prize = 1000 if roll < 0.02 else 200 if roll < 0.1 else 50 if roll < 0.4 else 0
-    USERS[uid]['money'] += prize
-    save_all()
-    msg = f'🎉 刮中 {prize} 金幣！' if prize else '😢 沒中獎，下次再試！'
+    if count > 1:
+        msg = '🎫 ' + ticket_summary(prizes, PRIZE_TABLES['scratch'].cost)
+    else:
+        msg = f'🎉 刮中 {prizes[0]} 金幣！' if prizes[0] else '😢 沒中獎，下次再試！'
     await inter.response.send_message(msg, ephemeral=True)
 
+
+def simulate_prizes(table: PrizeTable, trials: int) -> tuple:
+    """Monte-Carlo：抽 trials 張，回傳 (平均獎金, 變異數)。"""
+    draws = table.draw(trials, random.Random())
+    mean = sum(draws) / trials
+    var = sum((d - mean) ** 2 for d in draws) / max(trials - 1, 1)
+    return mean, var
+
+@bot.tree.command(name='prize_sim', description='模擬獎項表的期望值與變異數（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def prize_sim(inter: discord.Interaction, trials: app_commands.Range[int, 1000, 2_000_000] = 200_000):
+    async def work():
+        lines = [f'{"表":<8}{"成本":>6}{"理論EV":>10}{"模擬EV":>10}{"標準差":>10}{"回收率":>8}']
+        for name, t in PRIZE_TABLES.items():
+            ev, _ = t.expected()
+            mean, var = await asyncio.to_thread(simulate_prizes, t, trials)
+            lines.append(f'{name:<8}{t.cost:>6}{ev:>10.2f}{mean:>10.2f}{math.sqrt(var):>10.2f}{mean / t.cost:>8.1%}')
+        return f'🎰 每張 {trials} 次模擬\n```\n' + '\n'.join(lines) + '\n```'
+    await JOBS.submit(inter, 'prize_sim', work, ephemeral=True, timeout=120)
+
 # --- shop ---
 SHOP_ITEMS = {"VIP卡": 500, "道具A": 150, "道具B": 300, "神秘箱": 1000}
 
 @bot.tree.command(name='shop', description='購買商店道具（/shop item_name）', guild=discord.Object(id=GUILD_ID))
 @require_feature_permission()
 async def shop(inter: discord.Interaction, item_name: str):
-    uid = str(inter.user.id)
+    uid = member_key(inter.guild_id, inter.user.id)
     ensure_user(uid)
     if item_name not in SHOP_ITEMS:
         await inter.response.send_message('❌ 商店沒有這個道具', ephemeral=True)
         return
     price = SHOP_ITEMS[item_name]
-    if USERS[uid]['money'] < price:
+    try:
+        async with transaction(uid, reason='shop') as tx:
+            tx.debit(uid, price)
+            tx.add_item(uid, item_name, 1)
+    except InsufficientFunds:
         await inter.response.send_message('❌ 金幣不足購買', ephemeral=True)
         return
-    USERS[uid]['money'] -= price
-    USERS[uid]['items'][item_name] = USERS[uid]['items'].get(item_name, 0) + 1
-    save_all()
-    await inter.response.send_message(f'✅ 購買成功！你擁有 {USERS[uid]["items"][item_name]} 個 {item_name}')
+    at = tx.expires.get((uid, item_name))
+    until = f'（<t:{at}:R> 到期）' if at else ''
+    await inter.response.send_message(f'✅ 購買成功！你擁有 {USERS[uid]["items"][item_name]} 個 {item_name}{until}')
+
+# --- economy stats ---
+@bot.tree.command(name='economy_stats', description='經濟概況：貨幣總量、等級分布、道具、每日淨發行（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def economy_stats(inter: discord.Interaction, days: app_commands.Range[int, 1, ISSUANCE_KEEP_DAYS] = 7):
+    slot = guild_slot(inter.guild_id)
+    st = ECON_STATS[slot]
+    # 前 1% 從排行索引取前段，O(人數/100)
+    top_n = max(1, math.ceil(st.users / 100))
+    top_money = sum(score for _, score in MONEY_INDEX[slot].top(top_n))
+    share = top_money / st.money if st.money > 0 else 0
+    lines = [f"👥 {st.users} 人｜💰 總量 {st.money}（平均 {st.money / max(st.users, 1):.1f}）｜前 1%（{top_n} 人）持有 {share:.1%}"]
+    levels = sorted(st.levels.items())
+    lines.append("⭐ 等級分布：" + "、".join(f"Lv{lv}×{n}" for lv, n in levels[:15]) + ("…" if len(levels) > 15 else ""))
+    lines.append("🛒 商店（售出 / 持有）：" + "、".join(f"{name} {st.sold.get(name, 0)}/{st.items.get(name, 0)}" for name in SHOP_ITEMS))
+    today = day_number()
+    lines.append(f"📈 每日淨發行（近 {days} 天）：")
+    for d in range(today - days + 1, today + 1):
+        by_reason = st.issuance.get(d, {})
+        detail = "、".join(f"{r} {v:+d}" for r, v in sorted(by_reason.items(), key=lambda kv: -abs(kv[1])))
+        day = datetime.fromtimestamp(d * 86400, timezone.utc).strftime('%m-%d')
+        lines.append(f"`{day}` {sum(by_reason.values()):+d}" + (f"（{detail}）" if detail else ""))
+    await inter.response.send_message('\n'.join(lines), ephemeral=True)
 
 # --- level 查看 ---
 @bot.tree.command(name='level', description='查看當前等級與 XP', guild=discord.Object(id=GUILD_ID))
 @require_feature_permission()
 async def level(inter: discord.Interaction, member: discord.Member | None = None):
     m = member or inter.user
-    uid = str(m.id)
+    uid = member_key(inter.guild_id, m.id)
     ensure_user(uid)
     need = USERS[uid]['level'] * 100
     await inter.response.send_message(f"{m.display_name} 等級 {USERS[uid]['level']}｜XP {USERS[uid]['xp']}/{need}")
 
 # --- tickets 領票按鈕 ---
-class TicketClaimView(discord.ui.View):
+class TicketClaimView(TimedView):
     @discord.ui.button(label='領取票券', style=discord.ButtonStyle.success)
     async def claim(self, inter: discord.Interaction, button: discord.ui.Button):
-        uid = str(inter.user.id)
+        uid = member_key(inter.guild_id, inter.user.id)
         ensure_user(uid)
-        USERS[uid]['tickets'] += 1
-        save_all()
+        econ_apply(uid, 'ticket_claim', tickets=1)
         await inter.response.send_message('🎟️ 已領取 1 張票券！', ephemeral=True)
 
 @bot.tree.command(name='ticket_claim', description='發布領票按鈕（管理）', guild=discord.Object(id=GUILD_ID))
@@ -406,35 +2966,101 @@ async def ticket_claim(inter: discord.Interaction, message: str = '點擊按鈕
 # ----- Warnings & moderation -----
 @bot.tree.command(name='warn', description='警告用戶（管理）', guild=discord.Object(id=GUILD_ID))
 @require_admin()
-async def warn_cmd(inter: discord.Interaction, member: discord.Member, reason: str):
-    uid = str(member.id)
-    entry = f"{datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} - {reason} - by {inter.user.display_name}"
-    WARNINGS.setdefault(uid, []).append(entry)
-    save_all()
-    count = len(WARNINGS[uid])
-    try:
-        await member.send(f'⚠️ 你在 {inter.guild.name} 被警告（第 {count} 次）：{reason}')
-    except discord.Forbidden:
-        pass
-    await inter.response.send_message(f'⚠️ 已警告 {member.display_name}（第 {count} 次）')
+async def warn_cmd(inter: discord.Interaction, member: discord.Member, reason: str, expires: str | None = None):
+    seconds = parse_duration(expires) if expires else 0
+    if expires and seconds <= 0:
+        await inter.response.send_message('❌ 期限格式錯誤，例如 30d 或 12h', ephemeral=True)
+        return
+    count = add_warning(member_key(inter.guild_id, member.id), inter.user.id, reason, seconds)
+    until = f'，<t:{int(time.time()) + seconds}:R> 到期' if seconds else ''
+    OUTBOX.post(member, content=f'⚠️ 你在 {inter.guild.name} 被警告（第 {count} 次）：{reason}')
+    await inter.response.send_message(f'⚠️ 已警告 {member.display_name}（第 {count} 次{until}）')
+
+WARN_PAGE_SIZE = 10
+
+
+def format_warning(rec: dict, uid: str | None = None) -> str:
+    who = f"<@{rec['mod']}>" if rec.get('mod') else rec.get('by', '?')
+    target = f"<@{key_user(uid)}> " if uid else ''
+    exp = f" ⏳<t:{rec['exp']}:R>" if rec.get('exp') else ''
+    return f"<t:{rec['ts']}:f> {target}{rec['reason']}（by {who}）{exp}"
+
+
+class WarningsPager(TimedView):
+    """/warnings 分頁：fetch(page) 回傳 (該頁文字行, 總筆數)。"""
+
+    def __init__(self, owner: int, title: str, fetch):
+        super().__init__(timeout=300)
+        self.owner = owner
+        self.title = title
+        self.fetch = fetch
+        self.page = 0
+
+    def render(self) -> str:
+        lines, total = self.fetch(self.page)
+        pages = max(1, math.ceil(total / WARN_PAGE_SIZE))
+        self.prev_btn.disabled = self.page == 0
+        self.next_btn.disabled = self.page >= pages - 1
+        body = '\n'.join(lines) or '（沒有紀錄）'
+        return f'⚠️ {self.title}（共 {total} 筆，第 {self.page + 1}/{pages} 頁）\n{body}'
+
+    async def _turn(self, inter: discord.Interaction, delta: int):
+        if inter.user.id != self.owner:
+            await inter.response.send_message('只有查詢者可以翻頁', ephemeral=True)
+            return
+        self.page += delta
+        await inter.response.edit_message(content=self.render(), view=self)
+
+    @discord.ui.button(label='◀ 上一頁', style=discord.ButtonStyle.secondary)
+    async def prev_btn(self, inter: discord.Interaction, button: discord.ui.Button):
+        await self._turn(inter, -1)
 
-@bot.tree.command(name='warnings', description='查看警告記錄（管理）', guild=discord.Object(id=GUILD_ID))
+    @discord.ui.button(label='下一頁 ▶', style=discord.ButtonStyle.secondary)
+    async def next_btn(self, inter: discord.Interaction, button: discord.ui.Button):
+        await self._turn(inter, 1)
+
+@bot.tree.command(name='warnings', description='查看警告記錄（管理；不指定成員則列出最近的警告）', guild=discord.Object(id=GUILD_ID))
 @require_admin()
-async def warnings_cmd(inter: discord.Interaction, member: discord.Member):
-    uid = str(member.id)
-    logs = WARNINGS.get(uid, [])
-    if not logs:
-        await inter.response.send_message(f'✅ {member.display_name} 沒有任何警告')
+async def warnings_cmd(inter: discord.Interaction, member: discord.Member | None = None, include_archived: bool = False):
+    if member is None:
+        index = WARN_INDEX[guild_slot(inter.guild_id)]
+
+        def fetch(page):
+            rows = index.recent(page * WARN_PAGE_SIZE, WARN_PAGE_SIZE)
+            return [format_warning(rec, uid) for uid, rec in rows], len(index)
+        view = WarningsPager(inter.user.id, '最近的警告', fetch)
+        await inter.response.send_message(view.render(), view=view, ephemeral=True)
+        return
+
+    uid = member_key(inter.guild_id, member.id)
+
+    def pager(recs: list) -> dict | str:
+        if not recs:
+            return f'✅ {member.display_name} 沒有任何警告'
+        recs = recs[::-1]   # 新的在前
+
+        def fetch(page):
+            rows = recs[page * WARN_PAGE_SIZE:(page + 1) * WARN_PAGE_SIZE]
+            return [format_warning(rec) for rec in rows], len(recs)
+        view = WarningsPager(inter.user.id, f'{member.display_name} 的警告紀錄', fetch)
+        return {"content": view.render(), "view": view}
+
+    if include_archived:
+        # 封存段要解壓讀檔，交給工作佇列
+        async def work():
+            return pager(await asyncio.to_thread(read_archived_warnings, uid) + list(WARNINGS.get(uid, [])))
+        await JOBS.submit(inter, 'warnings_archive', work, ephemeral=True)
+        return
+    result = pager(list(WARNINGS.get(uid, [])))
+    if isinstance(result, str):
+        await inter.response.send_message(result)
     else:
-        text = ''.join(logs[-20:])
-        await inter.response.send_message(f'⚠️ {member.display_name} 的警告紀錄:{text}', ephemeral=True)
+        await inter.response.send_message(**result, ephemeral=True)
 
 @bot.tree.command(name='reset_warnings', description='重置警告（管理）', guild=discord.Object(id=GUILD_ID))
 @require_admin()
 async def reset_warnings(inter: discord.Interaction, member: discord.Member):
-    uid = str(member.id)
-    WARNINGS[uid] = []
-    save_all()
+    clear_warnings(member_key(inter.guild_id, member.id))
     await inter.response.send_message(f'✅ 已重置 {member.display_name} 的警告')
 
 @bot.tree.command(name='timeout', description='禁言（管理） 例如 /timeout @user 1h30m 違規', guild=discord.Object(id=GUILD_ID))
@@ -455,7 +3081,7 @@ async def timeout_cmd(inter: discord.Interaction, member: discord.Member, durati
 @bot.tree.command(name='announce_admin', description='管理員發布公告（送到指定頻道）', guild=discord.Object(id=GUILD_ID))
 @require_admin()
 async def announce_admin(inter: discord.Interaction, subject: str, content: str):
-    ch = bot.get_channel(ANNOUNCE_CHANNEL_ID)
+    ch = bot.get_channel(guild_conf(inter.guild_id)["announce_channel"])
     if not ch:
         await inter.response.send_message('❌ 找不到公告頻道', ephemeral=True)
         return
@@ -464,15 +3090,131 @@ async def announce_admin(inter: discord.Interaction, subject: str, content: str)
     await ch.send(embed=embed)
     await inter.response.send_message('✅ 公告已發佈', ephemeral=True)
 
+@bot.tree.command(name='schedule_announce', description='排程公告（管理）例如 when=2h30m；不指定頻道則送到公告頻道', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def schedule_announce(inter: discord.Interaction, when: str, subject: str, content: str,
+                            channel: discord.TextChannel | None = None):
+    seconds = parse_duration(when)
+    ch = channel or bot.get_channel(guild_conf(inter.guild_id)["announce_channel"])
+    if seconds <= 0 or not ch:
+        await inter.response.send_message('❌ 時間格式錯誤或找不到公告頻道', ephemeral=True)
+        return
+    embed = discord.Embed(title=subject, description=content, color=discord.Color.blurple())
+    embed.set_footer(text=f'發布人：{inter.user.display_name}')
+    at = int(time.time()) + seconds
+    sid = SCHEDULER.add("announce", at, guild_slot(inter.guild_id), channel=ch.id, embed=embed.to_dict())
+    await inter.response.send_message(f'🗓️ 已排程 `{sid}`：<t:{at}:f> 發到 {ch.mention}', ephemeral=True)
+
+SCHEDULE_LABELS = {"warn_expire": "警告到期", "item_expire": "道具到期", "announce": "排程公告"}
+
+
+def format_scheduled(sid: str) -> str:
+    a = SCHEDULE[sid]
+    args = a["args"]
+    if a["kind"] == "announce":
+        what = f"<#{args['channel']}> {args['embed'].get('title', '')}"
+    elif "uid" in args:
+        what = f"<@{key_user(args['uid'])}>" + (f" {args['item']}" if "item" in args else '')
+    else:
+        what = ''
+    return f"`{sid}` <t:{a['at']}:f> {SCHEDULE_LABELS.get(a['kind'], a['kind'])} {what}"
+
+@bot.tree.command(name='schedule_list', description='查看排程中的動作（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def schedule_list(inter: discord.Interaction, kind: Literal['all', 'warn_expire', 'item_expire', 'announce'] = 'all'):
+    slot = guild_slot(inter.guild_id)
+    rows = [sid for _, sid in SCHEDULER.pending(slot, len(SCHEDULE))
+            if kind == 'all' or SCHEDULE[sid]["kind"] == kind]
+    lines = [format_scheduled(sid) for sid in rows[:15]]
+    more = f'\n…另外 {len(rows) - 15} 筆' if len(rows) > 15 else ''
+    await inter.response.send_message(('\n'.join(lines) or '目前沒有排程') + more, ephemeral=True)
+
+@bot.tree.command(name='schedule_cancel', description='取消排程動作（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def schedule_cancel(inter: discord.Interaction, schedule_id: str):
+    a = SCHEDULE.get(schedule_id)
+    if not a or a["slot"] != guild_slot(inter.guild_id):
+        await inter.response.send_message('❌ 找不到這筆排程', ephemeral=True)
+        return
+    line = format_scheduled(schedule_id)
+    SCHEDULER.cancel(schedule_id)
+    await inter.response.send_message(f'🗑️ 已取消 {line}', ephemeral=True)
+
+@bot.tree.command(name='broadcast_channels', description='對多個頻道發布同一則公告（管理；channels 填 #頻道 或 ID）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def broadcast_channels(inter: discord.Interaction, channels: str, subject: str, content: str):
+    # 只送本伺服器的頻道（parse_member_ids 也適用於 <#頻道> / 頻道 ID）
+    targets = []
+    for cid in dict.fromkeys(parse_member_ids(channels)):
+        ch = bot.get_channel(cid)
+        if ch and getattr(ch, 'guild', None) and ch.guild.id == inter.guild_id:
+            targets.append(cid)
+    if not targets:
+        await inter.response.send_message('❌ 沒有可發送的頻道', ephemeral=True)
+        return
+    embed = discord.Embed(title=subject, description=content, color=discord.Color.blurple(), timestamp=datetime.utcnow())
+    embed.set_footer(text=f'發布人：{inter.user.display_name}')
+    bid = BROADCASTER.create("channels", inter.guild_id, inter.user.id, inter.channel_id, {"embed": embed.to_dict()}, targets)
+    await inter.response.send_message(f'📣 廣播 `{bid}` 開始：{len(targets)} 個頻道，完成後會在這裡回報', ephemeral=True)
+
+@bot.tree.command(name='broadcast_role', description='私訊某身分組的全部成員（管理；背景限速發送，完成後回報）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def broadcast_role(inter: discord.Interaction, role: discord.Role, content: str):
+    async def work():
+        members = await bulk_targets(inter, role, None)
+        if not members:
+            return f'❌ {role.name} 沒有可私訊的成員'
+        text = f'📢 來自 {inter.guild.name} 管理員 {inter.user.display_name}：{content}'
+        bid = BROADCASTER.create("role", inter.guild_id, inter.user.id, inter.channel_id,
+                                 {"content": text}, [m.id for m in members])
+        eta = len(members) / BROADCAST_RATE if BROADCAST_RATE > 0 else 0
+        return f'📣 廣播 `{bid}` 開始：{len(members)} 人，約 {math.ceil(eta / 60)} 分鐘，完成後會在這裡回報'
+    # 低記憶體模式要分頁抓成員，交給工作佇列
+    await JOBS.submit(inter, 'broadcast_role', work, ephemeral=True, timeout=120)
+
+@bot.tree.command(name='broadcast_status', description='查看廣播進度與送達報告（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def broadcast_status(inter: discord.Interaction):
+    ids = [bid for bid, b in BROADCASTS.items() if b["guild"] == inter.guild_id]
+    lines = [BROADCASTER.report(bid) for bid in ids[-10:]]
+    await inter.response.send_message('\n'.join(lines) or '目前沒有廣播紀錄', ephemeral=True)
+
+@bot.tree.command(name='broadcast_cancel', description='取消進行中的廣播（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def broadcast_cancel(inter: discord.Interaction, broadcast_id: str):
+    b = BROADCASTS.get(broadcast_id)
+    if not b or b["guild"] != inter.guild_id or not BROADCASTER.cancel(broadcast_id):
+        await inter.response.send_message('❌ 找不到進行中的這筆廣播', ephemeral=True)
+        return
+    await inter.response.send_message(f'⛔ 已取消廣播 `{broadcast_id}`', ephemeral=True)
+
 # ----- /dm （管理員/擁有者主動私訊）-----
 @bot.tree.command(name='dm', description='管理員/擁有者 私訊用戶', guild=discord.Object(id=GUILD_ID))
 @require_admin()
 async def dm(inter: discord.Interaction, user: discord.User, message: str):
-    try:
-        await user.send(f'📩 來自管理員 {inter.user.display_name}：{message}')
-        await inter.response.send_message('✅ 已發送私訊', ephemeral=True)
-    except discord.Forbidden:
-        await inter.response.send_message('❌ 用戶關閉私訊或無法傳送', ephemeral=True)
+    sent = OUTBOX.send(user, content=f'📩 來自管理員 {inter.user.display_name}：{message}')
+
+    async def work():
+        try:
+            await sent
+        except Exception:
+            return '❌ 用戶關閉私訊或無法傳送'
+        return '✅ 已發送私訊'
+    await JOBS.submit(inter, 'dm', work, ephemeral=True)
+
+@bot.tree.command(name='outbox_stats', description='查看訊息佇列狀態（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def outbox_stats(inter: discord.Interaction):
+    st = OUTBOX.stats()
+    await inter.response.send_message(
+        f"📮 佇列 {OUTBOX.depth()} 則（{len(OUTBOX.queues)} 個目標）｜已送 {st['sent']}｜合併 {st['coalesced']}"
+        f"｜重試 {st['retried']}｜丟棄 {st['dropped']}｜失敗 {st['failed']}\n"
+        f"⚙️ 工作佇列 {JOBS.depth()} 件等待｜執行中 {JOBS.running}/{JOBS.workers}", ephemeral=True)
+
+@bot.tree.command(name='memory', description='查看記憶體用量與成員數（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def memory_cmd(inter: discord.Interaction):
+    await inter.response.send_message('🧠 ' + memory_report(), ephemeral=True)
 
 # ----- /say 讓機器人說話 -----
 @bot.tree.command(name='say', description='讓 bot 發送訊息：「某某某說：內容」', guild=discord.Object(id=GUILD_ID))
@@ -484,17 +3226,176 @@ async def say_cmd(inter: discord.Interaction, message: str):
 @bot.tree.command(name='grant_feature', description='開通使用者功能權限（管理）', guild=discord.Object(id=GUILD_ID))
 @require_admin()
 async def grant_feature(inter: discord.Interaction, member: discord.Member):
-    FEATURE_PERMS[str(member.id)] = True
-    save_all()
+    key = member_key(inter.guild_id, member.id)
+    FEATURE_PERMS[key] = True
+    FEATURE_USERS.add(int(key))
+    mark_dirty('feature_perms', key)
     await inter.response.send_message(f'✅ 已開通 {member.display_name} 的功能權限')
 
 @bot.tree.command(name='revoke_feature', description='撤銷使用者功能權限（管理）', guild=discord.Object(id=GUILD_ID))
 @require_admin()
 async def revoke_feature(inter: discord.Interaction, member: discord.Member):
-    FEATURE_PERMS[str(member.id)] = False
-    save_all()
+    key = member_key(inter.guild_id, member.id)
+    FEATURE_PERMS[key] = False
+    FEATURE_USERS.discard(int(key))
+    mark_dirty('feature_perms', key)
     await inter.response.send_message(f'✅ 已撤銷 {member.display_name} 的功能權限')
 
+@bot.tree.command(name='grant_feature_role', description='開通整個身分組的功能權限（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def grant_feature_role(inter: discord.Interaction, role: discord.Role):
+    FEATURE_ROLES.add(role.id)
+    FEATURE_ROLE_MEMBERS.setdefault(inter.guild_id, set()).update(m.id for m in role.members)
+    mark_dirty('feature_roles', str(role.id))
+    count = '' if LOW_MEMORY else f'（{len(role.members)} 人）'
+    await inter.response.send_message(f'✅ 已開通身分組 {role.name} 的功能權限{count}')
+
+@bot.tree.command(name='revoke_feature_role', description='撤銷身分組的功能權限（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def revoke_feature_role(inter: discord.Interaction, role: discord.Role):
+    if role.id not in FEATURE_ROLES:
+        return await inter.response.send_message('❌ 這個身分組沒有被開通', ephemeral=True)
+    FEATURE_ROLES.discard(role.id)
+    mark_dirty('feature_roles', str(role.id))
+    # 成員可能同時擁有其他開通身分組，整個重算
+    rebuild_permission_cache(inter.guild)
+    await inter.response.send_message(f'✅ 已撤銷身分組 {role.name} 的功能權限')
+
+@bot.tree.command(name='guild_config', description='查看/設定本伺服器的管理身分組與頻道（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def guild_config(inter: discord.Interaction, admin_role: discord.Role | None = None,
+                       announce_channel: discord.TextChannel | None = None,
+                       dm_forward_channel: discord.TextChannel | None = None):
+    conf = guild_conf(inter.guild_id)
+    if dm_forward_channel and inter.guild_id != GUILD_ID:
+        return await inter.response.send_message('❌ 私訊轉發只會送到主伺服器', ephemeral=True)
+    changes = {k: v.id for k, v in (('admin_role', admin_role), ('announce_channel', announce_channel),
+                                    ('dm_forward_channel', dm_forward_channel)) if v}
+    if changes:
+        conf.update(changes)
+        mark_dirty('guilds', str(inter.guild_id))
+        if 'admin_role' in changes:
+            rebuild_permission_cache(inter.guild)
+    role = f"<@&{conf['admin_role']}>" if conf['admin_role'] else '（未設定，使用伺服器管理員權限）'
+    announce = f"<#{conf['announce_channel']}>" if conf['announce_channel'] else '（未設定）'
+    lines = [f"{'✅ 已更新' if changes else '⚙️ 目前設定'}（slot {conf['slot']}）",
+             f"管理身分組：{role}",
+             f"公告頻道：{announce}"]
+    if inter.guild_id == GUILD_ID:
+        lines.append(f"私訊轉發頻道：<#{conf['dm_forward_channel']}>")
+    await inter.response.send_message('\n'.join(lines), ephemeral=True)
+
+# ----- 批次管理（身分組或成員清單；一次套用、一次寫入） -----
+BULK_PROGRESS_EVERY = 1000   # 分頁抓成員時每掃過幾人更新一次進度
+
+
+def parse_member_ids(text: str | None) -> List[int]:
+    """從「@a @b 123...」這類文字取出 user id（mention 或純數字）。"""
+    return [int(x) for x in re.findall(r'\d{15,20}', text or '')]
+
+
+async def bulk_targets(inter: discord.Interaction, role: discord.Role | None, members: str | None,
+                       progress: 'BulkProgress | None' = None) -> List[discord.Member]:
+    targets: Dict[int, discord.Member] = {}
+    if role:
+        if LOW_MEMORY:   # role.members 是空的：分頁抓成員清單（不進快取），這段最慢，回報進度
+            scanned = 0
+            async for m in inter.guild.fetch_members(limit=None):
+                scanned += 1
+                if m.get_role(role.id) and not m.bot:
+                    targets[m.id] = m
+                if progress:
+                    await progress.scanned(scanned, len(targets))
+        else:
+            targets.update((m.id, m) for m in role.members if not m.bot)
+    found = await resolve_members(inter.guild, parse_member_ids(members))
+    targets.update((mid, m) for mid, m in found.items() if not m.bot)
+    return list(targets.values())
+
+
+class BulkProgress:
+    """解析目標（分頁抓成員）時每 BULK_PROGRESS_EVERY 人更新一次（已 defer 的）回覆。
+    套用本身只是記憶體操作，不在交易/迴圈裡 await。"""
+
+    def __init__(self, inter: discord.Interaction, title: str):
+        self.inter = inter
+        self.title = title
+
+    async def scanned(self, n: int, matched: int):
+        if n % BULK_PROGRESS_EVERY == 0:
+            await self.inter.edit_original_response(content=f'⏳ {self.title}：已掃描 {n} 位成員，符合 {matched} 人')
+
+    async def finish(self, text: str):
+        await self.inter.edit_original_response(content=text)
+
+
+async def start_bulk(inter: discord.Interaction, role, members, title: str):
+    """先 defer（抓成員可能要一點時間）再解析目標；沒有目標時回覆並回傳 None。"""
+    await inter.response.defer(ephemeral=True, thinking=True)
+    progress = BulkProgress(inter, title)
+    targets = await bulk_targets(inter, role, members, progress)
+    if not targets:
+        await inter.edit_original_response(content='❌ 沒有符合的成員（請指定 role 或 members）')
+        return None
+    return targets, progress
+
+@bot.tree.command(name='bulk_feature', description='批次開通/撤銷功能權限（管理；身分組取目前成員）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def bulk_feature(inter: discord.Interaction, action: Literal['grant', 'revoke'],
+                       role: discord.Role | None = None, members: str | None = None):
+    started = await start_bulk(inter, role, members, '開通權限' if action == 'grant' else '撤銷權限')
+    if not started:
+        return
+    targets, progress = started
+    grant = action == 'grant'
+    keys = []
+    for m in targets:
+        key = member_key(inter.guild_id, m.id)
+        FEATURE_PERMS[key] = grant
+        (FEATURE_USERS.add if grant else FEATURE_USERS.discard)(int(key))
+        keys.append(key)
+    mark_dirty('feature_perms', *keys)
+    await PERSIST.flush_async()
+    await progress.finish(f'✅ 已{"開通" if grant else "撤銷"} {len(keys)} 人的功能權限')
+
+@bot.tree.command(name='airdrop', description='批次發放金幣/票券/道具（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def airdrop(inter: discord.Interaction, role: discord.Role | None = None, members: str | None = None,
+                  money: app_commands.Range[int, 0, 1_000_000] = 0, tickets: app_commands.Range[int, 0, 1000] = 0,
+                  item: str | None = None, qty: app_commands.Range[int, 1, 1000] = 1):
+    if item is not None and item not in SHOP_ITEMS:
+        return await inter.response.send_message('❌ 商店沒有這個道具', ephemeral=True)
+    if not (money or tickets or item):
+        return await inter.response.send_message('❌ 請指定 money / tickets / item', ephemeral=True)
+    started = await start_bulk(inter, role, members, '發放中')
+    if not started:
+        return
+    targets, progress = started
+    uids = [member_key(inter.guild_id, m.id) for m in targets]
+    # 一筆交易：全部套用後一次寫 journal / 標記 dirty；區塊內不 await，帳戶鎖只握一瞬間
+    async with transaction(*uids, reason='airdrop') as tx:
+        for uid in uids:
+            if money:
+                tx.credit(uid, money, ref=str(inter.user.id))
+            if tickets:
+                tx.add_tickets(uid, tickets)
+            if item:
+                tx.add_item(uid, item, qty)
+    await PERSIST.flush_async()
+    gift = '、'.join(x for x in (money and f'{money} 金幣', tickets and f'{tickets} 張票券', item and f'{item}×{qty}') if x)
+    await progress.finish(f'🎁 已發放給 {len(uids)} 人：{gift}')
+
+@bot.tree.command(name='bulk_reset_warnings', description='批次重置警告（管理）', guild=discord.Object(id=GUILD_ID))
+@require_admin()
+async def bulk_reset_warnings(inter: discord.Interaction, role: discord.Role | None = None, members: str | None = None):
+    started = await start_bulk(inter, role, members, '重置警告')
+    if not started:
+        return
+    targets, progress = started
+    cleared = clear_warnings(*(member_key(inter.guild_id, m.id) for m in targets))
+    await PERSIST.flush_async()
+    await progress.finish(f'✅ 已重置 {cleared} 人的警告（共選取 {len(targets)} 人）')
+
 # ----- 擁有者：狀態設定/重置 -----
 @bot.tree.command(name='set_status', description='(擁有者) 自訂機器人狀態文字', guild=discord.Object(id=GUILD_ID))
 async def set_status(inter: discord.Interaction, text: str):
@@ -556,145 +3457,330 @@ class AdminReplyModal(discord.ui.Modal, title='回覆用戶'):
         super().__init__()
         self.target_id = target_id
         self.log_message_id = log_message_id
+        self.on_submit = timed_handler('modal:AdminReplyModal')(self.on_submit)
 
     async def on_submit(self, inter: discord.Interaction):
-        user = bot.get_user(self.target_id)
-        if not user:
-            await inter.response.send_message('找不到使用者', ephemeral=True)
-            return
-        try:
-            await user.send(f'📬 管理員 {inter.user.display_name} 回覆：{self.reply.value}')
-        except discord.Forbidden:
-            await inter.response.send_message('❌ 無法私訊該用戶', ephemeral=True)
-            return
-        # 在管理頻道建立回覆紀錄（使用 Discord 的回覆功能）
-        ch = bot.get_channel(DM_FORWARD_CHANNEL_ID)
-        if ch:
+        # 使用者不在快取時要打 API，先 defer 再做
+        async def work():
+            user = await get_or_fetch_user(self.target_id)
+            if not user:
+                return '找不到使用者'
             try:
-                ref = await ch.fetch_message(self.log_message_id)
-                log = await ch.send(content=f'🗨️ {inter.user.mention} 已回覆：{self.reply.value}', reference=ref)
-                # 記錄這則訊息以便日後清理
-                sess = DM_SESSIONS.get(self.target_id)
-                if sess:
-                    sess['messages'].append(log.id)
+                await OUTBOX.send(user, content=f'📬 管理員 {inter.user.display_name} 回覆：{self.reply.value}')
             except Exception:
-                pass
-        await inter.response.send_message('✅ 已回覆用戶', ephemeral=True)
+                return '❌ 無法私訊該用戶'
+            # 在管理頻道建立回覆紀錄（使用 Discord 的回覆功能；引用不需要先 fetch）
+            ch = bot.get_channel(guild_conf(GUILD_ID)["dm_forward_channel"])
+            if ch:
+                ref = ch.get_partial_message(self.log_message_id)
+                spawn(track_dm_message(self.target_id, OUTBOX.send(ch, content=f'🗨️ {inter.user.mention} 已回覆：{self.reply.value}', reference=ref)))
+            return '✅ 已回覆用戶'
+        await JOBS.submit(inter, 'dm_reply', work, ephemeral=True)
+
+
+async def track_dm_message(target_id: int, sent: asyncio.Future):
+    """等訊息送出後記到會話裡，以便日後清理。"""
+    try:
+        msg = await sent
+    except Exception:
+        return
+    sess = DM_SESSIONS.get(target_id)
+    if sess:
+        sess['messages'].append(msg.id)
+        mark_dirty('dm_sessions', str(target_id))
 
-class DMForwardView(discord.ui.View):
+class DMForwardView(TimedView):
     def __init__(self, target_id: int, log_message_id: int):
         super().__init__(timeout=None)
         self.target_id = target_id
         self.log_message_id = log_message_id
 
-    @discord.ui.button(label='回覆', style=discord.ButtonStyle.primary)
+    # 固定 custom_id：重啟後用 bot.add_view(..., message_id=...) 重新綁回原訊息
+    @discord.ui.button(label='回覆', style=discord.ButtonStyle.primary, custom_id='dm_forward:reply')
     async def reply_btn(self, inter: discord.Interaction, button: discord.ui.Button):
         if not is_admin_member(inter.user):
             await inter.response.send_message('你沒有權限回覆', ephemeral=True)
             return
         await inter.response.send_modal(AdminReplyModal(self.target_id, self.log_message_id))
 
-    @discord.ui.button(label='中斷對話', style=discord.ButtonStyle.danger)
+    @discord.ui.button(label='中斷對話', style=discord.ButtonStyle.danger, custom_id='dm_forward:end')
     async def end_btn(self, inter: discord.Interaction, button: discord.ui.Button):
         if not is_admin_member(inter.user):
             await inter.response.send_message('你沒有權限中斷', ephemeral=True)
             return
-        # DM 使用者通知
-        user = bot.get_user(self.target_id)
-        if user:
-            try:
-                await user.send('💬 管理員已中斷對話。')
-            except discord.Forbidden:
-                pass
-
-        # 清理頻道中該會話的所有訊息
-        sess = DM_SESSIONS.get(self.target_id)
-        ch = bot.get_channel(DM_FORWARD_CHANNEL_ID)
-        if sess and ch:
-            ids = sess.get('messages', [])
-            for mid in ids:
-                try:
-                    msg = await ch.fetch_message(mid)
-                    await msg.delete()
-                except Exception:
-                    pass
-            # 移除會話
-            DM_SESSIONS.pop(self.target_id, None)
-            # 留下一條紀錄
-            try:
-                await ch.send(f'⛔ 與 <@{self.target_id}> 的對話已由 {inter.user.mention} 中斷（紀錄保留）。')
-            except Exception:
-                pass
-        await inter.response.send_message('✅ 已中斷對話並清除訊息', ephemeral=True)
+        # 先 defer，通知與清理交給工作佇列，做完再回報；
+        # 會話在工作開始時才移除，佇列滿被拒絕時會話還在，可以再按一次
+        async def work():
+            sess = DM_SESSIONS.pop(self.target_id, None)
+            if sess is None:
+                return '此對話已經中斷'
+            mark_dirty('dm_sessions', str(self.target_id))
+            await end_dm_session(self.target_id, sess, inter.user.mention)
+            return '✅ 已中斷對話並清除訊息'
+        await JOBS.submit(inter, 'dm_end', work, ephemeral=True, timeout=300)
+
+
+# bulk delete 只接受 14 天內的訊息，留一點緩衝
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=10)
+
+
+async def purge_messages(ch: discord.TextChannel, ids: List[int]):
+    """刪除一批訊息：14 天內的以 100 則為一組 bulk delete，其餘（或 bulk 失敗的）小批並行逐筆刪。"""
+    cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+    recent = [m for m in ids if discord.utils.snowflake_time(m) > cutoff]
+    single = [m for m in ids if discord.utils.snowflake_time(m) <= cutoff]
+    for i in range(0, len(recent), 100):
+        chunk = recent[i:i + 100]
+        try:
+            await ch.delete_messages([discord.Object(id=m) for m in chunk])
+        except discord.HTTPException:
+            single.extend(chunk)
+
+    async def delete_one(mid: int):
+        try:
+            await ch.get_partial_message(mid).delete()
+        except discord.HTTPException:
+            pass
+
+    for i in range(0, len(single), 5):
+        await asyncio.gather(*(delete_one(m) for m in single[i:i + 5]))
+
+
+async def end_dm_session(target_id: int, sess: dict | None, by: str):
+    # DM 使用者通知
+    user = await get_or_fetch_user(target_id)
+    if user:
+        OUTBOX.post(user, content='💬 管理員已中斷對話。')
+
+    # 清理頻道中該會話的所有訊息
+    ch = bot.get_channel(sess['channel']) if sess else None
+    if sess and ch:
+        await purge_messages(ch, sess.get('messages', []))
+        # 留下一條紀錄
+        try:
+            await ch.send(f'⛔ 與 <@{target_id}> 的對話已由 {by} 中斷（紀錄保留）。')
+        except Exception:
+            pass
+
+
+def restore_dm_views():
+    """重啟後把持久化會話的按鈕重新綁回原本的訊息。"""
+    for target_id, sess in DM_SESSIONS.items():
+        for view_id, log_id in sess.get('views', []):
+            bot.add_view(DMForwardView(target_id, log_id), message_id=view_id)
+
+async def forward_dm(message: discord.Message, ch: discord.TextChannel):
+    embed = discord.Embed(title='用戶私訊轉發', description=message.content or '(無文字)', color=discord.Color.green(), timestamp=datetime.utcnow())
+    embed.set_author(name=f'{message.author} (ID: {message.author.id})', icon_url=message.author.display_avatar.url)
+    try:
+        log = await OUTBOX.send(ch, embed=embed)
+        # 建立/更新會話追蹤
+        sess = DM_SESSIONS.setdefault(message.author.id, {"channel": ch.id, "messages": []})
+        sess['messages'].append(log.id)
+        # 附上按鈕（使用回覆引用功能），直接帶 view 送出，不用再 edit
+        view = DMForwardView(message.author.id, log.id)
+        view_msg = await OUTBOX.send(ch, content="請使用下方按鈕處理（回覆 / 中斷）", reference=log, view=view)
+        sess['messages'].append(view_msg.id)
+        sess.setdefault('views', []).append([view_msg.id, log.id])
+        mark_dirty('dm_sessions', str(message.author.id))
+        OUTBOX.post(message.author, content='✅ 已轉發給管理員，請稍候。')
+    except Exception:
+        pass
+
 
 @bot.event
+@timed_handler('on_message')
 async def on_message(message: discord.Message):
     # 先讓指令能運作
     await bot.process_commands(message)
+    MESSAGES_TOTAL.inc(kind='dm' if message.guild is None else 'guild')
 
     if message.author.bot:
         return
 
-    # 私訊 -> 轉發到管理頻道
+    # 私訊 -> 轉發到管理頻道（背景處理，不卡住事件）
     if isinstance(message.channel, discord.DMChannel):
-        ch = bot.get_channel(DM_FORWARD_CHANNEL_ID)
+        ch = bot.get_channel(guild_conf(GUILD_ID)["dm_forward_channel"])
         if ch:
-            embed = discord.Embed(title='用戶私訊轉發', description=message.content or '(無文字)', color=discord.Color.green(), timestamp=datetime.utcnow())
-            embed.set_author(name=f'{message.author} (ID: {message.author.id})', icon_url=message.author.display_avatar.url if message.author.display_avatar else discord.Embed.Empty)
-            try:
-                log = await ch.send(embed=embed)
-                # 建立/更新會話追蹤
-                sess = DM_SESSIONS.setdefault(message.author.id, {"channel": ch.id, "messages": []})
-                sess['messages'].append(log.id)
-                # 附上按鈕（使用回覆引用功能）
-                view_msg = await ch.send(content=f"請使用下方按鈕處理（回覆 / 中斷）", reference=log)
-                sess['messages'].append(view_msg.id)
-                await view_msg.edit(view=DMForwardView(message.author.id, log.id))
-
-                try:
-                    await message.author.send('✅ 已轉發給管理員，請稍候。')
-                except discord.Forbidden:
-                    pass
-            except Exception:
-                pass
+            spawn(forward_dm(message, ch))
         else:
-            try:
-                await message.author.send('管理員頻道未設定，無法轉發。')
-            except discord.Forbidden:
-                pass
+            OUTBOX.post(message.author, content='管理員頻道未設定，無法轉發。')
         return
 
-    # 公會內訊息：給 XP & 少量金錢，自動升級公告
+    # 公會內訊息：給 XP & 少量金錢（先進緩衝，批次套用後才發升級公告）
     if message.guild and message.author:
-        uid = str(message.author.id)
-        ensure_user(uid)
-        USERS[uid]['xp'] += 5
-        USERS[uid]['money'] += random.randint(0, 2)
-        leveled = False
-        while USERS[uid]['xp'] >= USERS[uid]['level'] * 100:
-            USERS[uid]['xp'] -= USERS[uid]['level'] * 100
-            USERS[uid]['level'] += 1
-            leveled = True
-        if leveled:
-            try:
-                await message.channel.send(f'🎉 {message.author.mention} 升級到 {USERS[uid]["level"]} 級！')
-            except Exception:
-                pass
-        save_all()
+        queue_message_xp(message)
 
-# ===== Flask（Render 保活） =====
-app = Flask(__name__)
+@bot.event
+async def on_app_command_completion(inter: discord.Interaction, command):
+    COMMAND_LATENCY.observe((discord.utils.utcnow() - inter.created_at).total_seconds(), command=command.qualified_name)
 
-@app.route('/')
-def home():
-    return 'Bot is running.'
+# ----- 擁有者：取樣 profiler -----
+PROFILER_STOP: threading.Event | None = None
 
 
-def run_web():
-    app.run(host='0.0.0.0', port=PORT)
+@bot.tree.command(name='profiler', description='(擁有者) 取樣 event loop N 秒並列出熱點', guild=discord.Object(id=GUILD_ID))
+async def profiler(inter: discord.Interaction, action: Literal['start', 'stop'] = 'start', seconds: int = 10):
+    global PROFILER_STOP
+    if inter.user.id != OWNER_ID:
+        await inter.response.send_message('🚫 僅擁有者可用', ephemeral=True)
+        return
+    if action == 'stop':
+        if PROFILER_STOP:
+            PROFILER_STOP.set()
+        await inter.response.send_message('⏹️ 已停止取樣' if PROFILER_STOP else '目前沒有在取樣', ephemeral=True)
+        return
+    if PROFILER_STOP:
+        await inter.response.send_message('⏳ 已經在取樣中', ephemeral=True)
+        return
+    seconds = max(1, min(120, seconds))
+    await inter.response.defer(ephemeral=True, thinking=True)
+    PROFILER_STOP = stop = threading.Event()
+    try:
+        own, cum, n = await asyncio.to_thread(sample_stacks, LOOP_THREAD_ID, seconds, stop)
+    finally:
+        PROFILER_STOP = None
+    if not n:
+        await inter.followup.send('沒有取到樣本', ephemeral=True)
+        return
+    lines = [f'取樣 {n} 次', '— 最上層（self）—']
+    lines += [f'{c * 100 / n:5.1f}% {k}' for k, c in own.most_common(10)]
+    lines += ['— 累計（含呼叫）—']
+    lines += [f'{c * 100 / n:5.1f}% {k}' for k, c in cum.most_common(10)]
+    await inter.followup.send('```' + '\n'.join(lines)[:1900] + '```', ephemeral=True)
+
+
+def instrument_handlers():
+    """所有 slash 指令的 callback 包上 timed_handler（按鈕由 TimedView 處理）。"""
+    for cmd in bot.tree.walk_commands(guild=discord.Object(id=GUILD_ID)):
+        if isinstance(cmd, app_commands.Command):
+            cmd._callback = timed_handler(f'/{cmd.qualified_name}')(cmd._callback)
+
+
+instrument_handlers()
+STARTUP["import"] = time.perf_counter() - _IMPORT_START
+
+# ===== 健康檢查 / metrics（aiohttp，跑在 bot 的 event loop 內；Render 偵測 PORT） =====
+LOOP_LAG_WARN = float(os.environ.get("LOOP_LAG_WARN", 1.0))   # 秒；超過就回報不健康
+LOOP_LAG = 0.0
+
+
+async def monitor_loop_lag(interval: float = 0.1):
+    """量 loop 延遲，同時更新給 LoopWatchdog 看的心跳。"""
+    global LOOP_LAG, LOOP_HEARTBEAT
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG = max(0.0, time.perf_counter() - start - interval)
+        LOOP_HEARTBEAT = time.monotonic()
+
+
+metric(Gauge("bot_event_loop_lag_seconds", "Event loop scheduling lag", lambda: LOOP_LAG))
+metric(Gauge("bot_gateway_latency_seconds", "Gateway heartbeat latency", lambda: -1 if math.isnan(bot.latency) else bot.latency))
+metric(Gauge("bot_economy_money_supply", "Total money held by all users", lambda: sum(st.money for st in ECON_STATS.values())))
+metric(Gauge("bot_users_records", "Economy user records in memory", lambda: USERS.resident()))
+metric(Gauge("bot_cached_users", "discord.py cached users", lambda: len(bot.users)))
+metric(Gauge("bot_process_rss_bytes", "Resident set size", rss_bytes))
+metric(Gauge("bot_guild_members", "Members across all guilds (from guild member_count)", lambda: sum(g.member_count or 0 for g in bot.guilds)))
+metric(Gauge("bot_cached_members", "discord.py cached guild members", lambda: sum(len(g.members) for g in bot.guilds)))
+metric(Gauge("bot_cached_messages", "discord.py cached messages", lambda: len(bot.cached_messages)))
+metric(Gauge("bot_job_queue_depth", "Deferred jobs waiting for a worker", JOBS.depth))
+metric(Gauge("bot_jobs_running", "Deferred jobs currently running", lambda: JOBS.running))
+metric(Gauge("bot_dm_sessions", "Open DM forward sessions", lambda: len(DM_SESSIONS)))
+metric(Gauge("bot_xp_pending", "Buffered message XP grants", lambda: len(XP_PENDING)))
+metric(Gauge("bot_outbox_depth", "Queued outbound messages", lambda: OUTBOX.depth()))
+
+
+async def web_root(request: web.Request):
+    return web.Response(text='Bot is running.')
+
+
+async def web_healthz(request: web.Request):
+    latency = None if math.isnan(bot.latency) else bot.latency   # 還沒心跳時是 nan
+    ok = not bot.is_closed() and LOOP_LAG < LOOP_LAG_WARN
+    body = {
+        "gateway": "connected" if bot.is_ready() and not bot.is_closed() else "disconnected",
+        "latency": latency,
+        "loop_lag": round(LOOP_LAG, 4),
+    }
+    return web.json_response(body, status=200 if ok else 503)
+
+
+async def web_readyz(request: web.Request):
+    ready = bot.is_ready() and STATE_LOADED
+    return web.Response(text='ready' if ready else 'not ready', status=200 if ready else 503)
+
+
+async def web_metrics(request: web.Request):
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+
+async def start_web():
+    app = web.Application()
+    app.router.add_get('/', web_root)
+    app.router.add_get('/healthz', web_healthz)
+    app.router.add_get('/readyz', web_readyz)
+    app.router.add_get('/metrics', web_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host='0.0.0.0', port=PORT).start()
 
 # ===== Entrypoint =====
+def run_shard_groups(groups: int):
+    """把 shard 平均分成 groups 組，每組一個子行程（各自的 PORT / DATA_DIR），等它們結束。
+    主伺服器所在的那組沿用 DATA_DIR，其他組用 DATA_DIR/group-N。"""
+    count = SHARD_COUNT or groups
+    home = shard_of_count(GUILD_ID, count)
+    procs = []
+    for i in range(groups):
+        ids = list(range(i, count, groups))
+        env = dict(os.environ, SHARD_COUNT=str(count), SHARD_IDS=",".join(map(str, ids)), PORT=str(PORT + i),
+                   DATA_DIR=DATA_DIR if home in ids else os.path.join(DATA_DIR, f"group-{i}"))
+        print(f"🚀 shard group {i}：shards {ids}，PORT {env['PORT']}，DATA_DIR {env['DATA_DIR']}")
+        procs.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+    try:
+        for p in procs:
+            p.wait()
+    except KeyboardInterrupt:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait()
+
+
 if __name__ == '__main__':
-    # 開一條 Flask 執行緒，讓 Render 偵測埠口
-    threading.Thread(target=run_web, daemon=True).start()
-    bot.run(TOKEN)
+    if '--migrate-sqlite' in sys.argv:
+        migrate_json_to_sqlite()
+        sys.exit(0)
+    if '--shard-groups' in sys.argv:
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        run_shard_groups(int(sys.argv[sys.argv.index('--shard-groups') + 1]))
+        sys.exit(0)
+    if not TOKEN:
+        raise RuntimeError("環境變數 DISCORD_TOKEN 未設定")
+    # Render 停機送 SIGTERM：轉成 KeyboardInterrupt 讓 bot 正常收尾
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    discord.utils.setup_logging()
+
+    async def run_bot():
+        global LOAD_TASK
+        async with bot:
+            # HTTP 先起來（平台的 port 偵測不用等登入/讀檔），就緒與否交給 /readyz
+            await start_web()
+            # 讀檔丟到執行緒，和 HTTP 登入並行；setup_hook 會等它完成
+            LOAD_TASK = asyncio.create_task(asyncio.to_thread(load_state))
+            STARTUP["login_start"] = time.perf_counter()
+            await bot.start(TOKEN)
+
+    try:
+        asyncio.run(run_bot())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # 資料沒載入完就不要寫回，避免用空狀態蓋掉檔案
+        if STATE_LOADED:
+            drain_message_xp()
+            mark_stats_dirty()
+            if ECONOMY_JOURNAL:
+                JOURNAL.compact_sync()
+            PERSIST.flush()
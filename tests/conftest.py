@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# main 在 import 時決定資料目錄；測試一律用暫存目錄，不動到 ./data
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bot-test-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
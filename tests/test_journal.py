@@ -0,0 +1,109 @@
+import main
+
+
+def make_journal(tmp_path):
+    journal = main.EconomyJournal(str(tmp_path / "economy.journal"), str(tmp_path / "archive"))
+    journal.open()
+    return journal
+
+
+def item_event(uid: str, item: str, qty: int, count: int) -> dict:
+    return {"ts": 0, "uid": uid, "r": "shop", "item": [item, qty, count], "bal": [100, 0, 1, 0]}
+
+
+def test_replay_restores_items(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append(item_event("5", "道具A", 2, 2))
+    users = main.UserStore()
+    assert make_journal(tmp_path).replay(users) == 1
+    assert users["5"].to_dict() == {"money": 100, "xp": 0, "level": 1, "tickets": 0, "items": {"道具A": 2}}
+
+
+def test_replay_drops_items_that_reached_zero(tmp_path):
+    # 買了 VIP卡 又到期收回：重播後不應留下 {'VIP卡': 0}
+    journal = make_journal(tmp_path)
+    journal.append(item_event("5", "VIP卡", 1, 1), item_event("5", "道具A", 1, 1))
+    journal.append(item_event("5", "VIP卡", -1, 0))
+    users = main.UserStore()
+    make_journal(tmp_path).replay(users)
+    assert users["5"].get("items") == {"道具A": 1}
+
+
+def test_replay_zero_count_on_fresh_user_leaves_no_items(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append(item_event("6", "VIP卡", -1, 0))
+    users = main.UserStore()
+    make_journal(tmp_path).replay(users)
+    assert "items" not in users["6"].to_dict()
+
+
+def test_event_timestamp_is_epoch_seconds(monkeypatch):
+    # utcnow().timestamp() 會把 UTC 當成本地時間，TZ 非 UTC 時差好幾小時
+    monkeypatch.setattr(main.time, "time", lambda: 1_700_000_000.5)
+    main.USERS["7"] = main.UserRecord()
+    try:
+        assert main._econ_event("7", "test", money=1)["ts"] == 1_700_000_000
+    finally:
+        del main.USERS["7"]
+
+
+def test_append_over_compact_limit_without_loop(tmp_path, monkeypatch):
+    # 關機時 asyncio.run 已結束才 drain_message_xp()：不能因為沒有 loop 而丟例外
+    monkeypatch.setattr(main, "COMPACT_MAX_EVENTS", 1)
+    journal = make_journal(tmp_path)
+    journal.append(item_event("5", "道具A", 1, 1), item_event("5", "道具A", 1, 2))
+    assert journal.count == 2
+
+
+def test_compact_keeps_old_segment_after_failed_flush(tmp_path, monkeypatch):
+    import asyncio
+    import os
+
+    backend = main.SqliteBackend(str(tmp_path / "bot.db"))
+    users = main.UserStore()
+    persist = main.WriteBehind(backend, {"users": lambda: users}, max_changes=10_000)
+    monkeypatch.setattr(main, "PERSIST", persist)
+    real_write = backend.write
+    calls = []
+
+    def flaky(*args):
+        calls.append(args[0])
+        if len(calls) == 1:
+            raise OSError("database is locked")
+        real_write(*args)
+    backend.write = flaky
+
+    journal = make_journal(tmp_path)
+    users.create("111").money = 500
+    journal.append({"ts": 0, "uid": "111", "r": "pay", "delta_money": 500, "bal": [500, 0, 1, 0]})
+
+    async def run():
+        try:
+            await journal.compact()
+        except OSError:
+            pass
+        assert "111" in journal.touched
+        assert os.path.exists(journal.path + ".old")
+        await journal.compact()
+    asyncio.run(run())
+    assert backend.get("users", "111")["money"] == 500
+    assert not os.path.exists(journal.path + ".old")
+
+
+def test_archive_retention_is_by_age(tmp_path, monkeypatch):
+    import os
+
+    monkeypatch.setattr(main, "JOURNAL_KEEP_DAYS", 30)
+    journal = make_journal(tmp_path)
+    os.makedirs(journal.archive_dir)
+    for name in ("20000101T000000-1.jsonl", "29990101T000000-2.jsonl"):
+        open(os.path.join(journal.archive_dir, name), "w").close()
+    # 短時間內壓縮很多次也不會擠掉還在保留期內的段落
+    for _ in range(60):
+        journal.append(item_event("5", "道具A", 1, 1))
+        journal._rotate()
+        journal._archive_old()
+    kept = os.listdir(journal.archive_dir)
+    assert "20000101T000000-1.jsonl" not in kept
+    assert "29990101T000000-2.jsonl" in kept
+    assert len(kept) >= 2
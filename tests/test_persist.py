@@ -0,0 +1,89 @@
+import json
+
+import main
+
+
+def make_persist(tmp_path, data: dict):
+    backend = main.SqliteBackend(str(tmp_path / "bot.db"))
+    return backend, main.WriteBehind(backend, {"daily": lambda: data}, max_changes=10_000)
+
+
+def test_whole_store_rewrite_deletes_removed_keys(tmp_path):
+    data = {"1": 100, "2": 200, "3": 300}
+    backend, persist = make_persist(tmp_path, data)
+    persist.mark("daily")
+    persist.flush()
+    # 像 load_daily 清掉過期紀錄後整份標記
+    del data["1"], data["2"]
+    persist.mark("daily")
+    persist.flush()
+    assert backend.load("daily") == {"3": 300}
+
+
+def test_row_level_mark_keeps_other_rows(tmp_path):
+    data = {"1": 100, "2": 200}
+    backend, persist = make_persist(tmp_path, data)
+    persist.mark("daily")
+    persist.flush()
+    data["2"] = 201
+    persist.mark("daily", "2")
+    persist.flush()
+    assert backend.load("daily") == {"1": 100, "2": 201}
+
+
+def test_json_backend_accepts_replace(tmp_path):
+    backend = main.JsonBackend({"daily": str(tmp_path / "daily.json")})
+    backend.write("daily", json.dumps({"3": 300}), True)
+    assert backend.load("daily") == {"3": 300}
+
+
+def test_mark_over_limit_without_loop_flushes_synchronously(tmp_path):
+    data = {"1": 100}
+    backend = main.SqliteBackend(str(tmp_path / "bot.db"))
+    persist = main.WriteBehind(backend, {"daily": lambda: data}, max_changes=1)
+    persist.mark("daily", "1")
+    assert backend.load("daily") == {"1": 100}
+
+
+class FlakyBackend(main.JsonBackend):
+    def __init__(self, files, fail_times: int):
+        super().__init__(files)
+        self.fail_times = fail_times
+
+    def write(self, name, payload, replace=True):
+        if self.fail_times:
+            self.fail_times -= 1
+            raise OSError("disk full")
+        super().write(name, payload, replace)
+
+
+def test_failed_json_write_is_retried(tmp_path):
+    data = {}
+    backend = FlakyBackend({"feature_perms": str(tmp_path / "feature_perms.json")}, fail_times=1)
+    persist = main.WriteBehind(backend, {"feature_perms": lambda: data}, max_changes=10_000)
+    data["5"] = True
+    persist.mark("feature_perms")
+    try:
+        persist.flush()
+    except OSError:
+        pass
+    # 內容沒再變：上一輪沒寫成，不能當成「沒變」跳過
+    persist.mark("feature_perms")
+    persist.flush()
+    assert backend.load("feature_perms") == {"5": True}
+
+
+def test_failed_sqlite_rows_stay_dirty(tmp_path):
+    data = {"1": 100, "2": 200}
+    backend = main.SqliteBackend(str(tmp_path / "bot.db"))
+    persist = main.WriteBehind(backend, {"daily": lambda: data}, max_changes=10_000)
+    real_write = backend.write
+    backend.write = lambda *a: (_ for _ in ()).throw(OSError("locked"))
+    persist.mark("daily", "1", "2")
+    try:
+        persist.flush()
+    except OSError:
+        pass
+    backend.write = real_write
+    persist.flush()
+    assert backend.load("daily") == {"1": 100, "2": 200}
@@ -0,0 +1,36 @@
+import main
+
+
+def make_store(tmp_path, capacity: int):
+    backend = main.SqliteBackend(str(tmp_path / "bot.db"))
+    users = main.CachedUserStore(backend, capacity)
+    persist = main.WriteBehind(backend, {"users": lambda: users}, max_changes=10_000)
+    return backend, users, persist
+
+
+def test_flush_does_not_readmit_evicted_records(tmp_path, monkeypatch):
+    backend, users, persist = make_store(tmp_path, 3)
+    monkeypatch.setattr(main, "mark_dirty", persist.mark)
+    for uid in range(1, 6):   # 1、2 被擠出去（dirty → evicted）
+        users.create(str(uid)).money = uid * 100
+        persist.mark("users", str(uid))
+    before = dict(main.USER_CACHE.values)
+    persist.flush()
+    assert list(users._d) == [3, 4, 5]
+    assert not users.evicted and not users.inflight
+    assert main.USER_CACHE.values == before   # 序列化不算快取查詢
+    assert backend.get("users", "2")["money"] == 200
+
+
+def test_deleted_record_is_removed_but_unknown_key_is_kept(tmp_path, monkeypatch):
+    backend, users, persist = make_store(tmp_path, 3)
+    monkeypatch.setattr(main, "mark_dirty", persist.mark)
+    for uid in range(1, 6):
+        users.create(str(uid))
+        persist.mark("users", str(uid))
+    persist.flush()
+    del users["5"]
+    persist.mark("users", "1")   # 1 已寫回、不在記憶體：不能被當成刪除
+    persist.flush()
+    assert backend.get("users", "5") is None
+    assert backend.get("users", "1") is not None